@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Time download_datafiles on a synthetic SQLite study for several numbers of
+export processes (--jobs), and check that every run writes the same files.
+
+Run from a psiTurk project folder (e.g. one made by psiturk-setup-example):
+
+    python ../benchmarks/export_scaling.py [--participants 100000]
+        [--trials 40] [--jobs 1 2 4 8]
+
+The study is built in a temporary folder, which is removed afterwards.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import filecmp
+import tempfile
+import datetime
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def synthetic_datastring(uniqueid, trials):
+    return json.dumps({
+        'currenttrial': trials,
+        'data': [{'uniqueid': uniqueid, 'current_trial': trial,
+                  'dateTime': 1500000000000 + trial * 1500,
+                  'trialdata': {'phase': 'TEST', 'word': 'RED',
+                                'color': 'blue', 'response': 'b',
+                                'hit': trial % 3 != 0,
+                                'rt': 400 + (trial * 37) % 600}}
+                 for trial in range(trials)],
+        'eventdata': [{'eventtype': 'focus', 'interval': 0,
+                       'value': 'on', 'timestamp': 1500000000000 + event}
+                      for event in range(trials // 10 + 1)],
+        'questiondata': {'engagement': '5', 'difficulty': '3',
+                         'comments': 'none'}})
+
+
+def build_study(participants, trials):
+    from psiturk.db import engine, init_db
+    from psiturk.models import Participant
+    init_db()
+    table = Participant.__table__
+    began = datetime.datetime(2018, 1, 1)
+    batch = []
+    for number in range(participants):
+        uniqueid = 'worker%06d:assignment%06d' % (number, number)
+        batch.append(dict(
+            uniqueid=uniqueid, assignmentid='assignment%06d' % number,
+            workerid='worker%06d' % number, hitid='bench', cond=0,
+            counterbalance=0, codeversion='1.0', beginhit=began,
+            status=3, mode='live',
+            datastring=synthetic_datastring(uniqueid, trials)))
+        if len(batch) == 5000:
+            engine.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        engine.execute(table.insert(), batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--participants', type=int, default=100000)
+    parser.add_argument('--trials', type=int, default=40)
+    parser.add_argument('--jobs', type=int, nargs='+',
+                        default=[1, 2, 4, multiprocessing.cpu_count()])
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        from psiturk.psiturk_config import get_config
+        config = get_config()
+        config.set('Database Parameters', 'database_url',
+                   'sqlite:///' + os.path.join(folder, 'study.db'))
+        config.set('Database Parameters', 'normalized_data', 'false')
+        config.set('Database Parameters', 'datastring_compression', 'none')
+        began = time.time()
+        build_study(args.participants, args.trials)
+        print 'Built %d participants with %d trials each in %.1fs' % (
+            args.participants, args.trials, time.time() - began)
+        print '%d cores' % multiprocessing.cpu_count()
+
+        from psiturk.data_export import export_datafiles, DATAFILES
+        first = None
+        for jobs in sorted(set(args.jobs)):
+            directory = os.path.join(folder, 'jobs%d' % jobs)
+            os.mkdir(directory)
+            began = time.time()
+            export_datafiles(directory, jobs=jobs)
+            elapsed = time.time() - began
+            if first is None:
+                first = directory
+                baseline = elapsed
+                same = True
+            else:
+                same = all(filecmp.cmp(os.path.join(first, name + '.csv'),
+                                       os.path.join(directory, name + '.csv'),
+                                       shallow=False)
+                           for name in DATAFILES)
+            print '--jobs %-3d %7.1fs  %5.2fx  %s' % (
+                jobs, elapsed, baseline / elapsed,
+                'same files' if same else 'FILES DIFFER')
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
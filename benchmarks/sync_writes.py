@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent /sync saves against a SQLite database, with and without
+`sqlite_wal`, to show what the SQLite pragmas set in psiturk/db.py buy.
+
+Run from a psiTurk project folder (e.g. one made by psiturk-setup-example):
+
+    python ../benchmarks/sync_writes.py [--workers 8] [--saves 100]
+
+Each worker is a separate process, like a gunicorn worker, with its own
+participant, and saves a growing data string then reads it back `saves`
+times. The database is a fresh file in a temporary folder.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def setup(database_url, wal):
+    ''' Point the shared config at the benchmark database, then load the
+    server. Only done in child processes, so each gets its own engine. '''
+    from psiturk.psiturk_config import get_config
+    config = get_config()
+    config.set('Database Parameters', 'database_url', database_url)
+    config.set('Database Parameters', 'sqlite_wal', str(wal).lower())
+    config.set('Server Parameters', 'logfile', os.devnull)
+    import psiturk.experiment
+    return psiturk.experiment
+
+
+def create_participants(database_url, wal, workers):
+    experiment = setup(database_url, wal)
+    from psiturk.db import db_session, init_db
+    from psiturk.models import Participant
+    init_db()
+    for number in range(workers):
+        db_session.add(Participant(workerid='bench%d' % number,
+                                   assignmentid='bench', hitid='bench',
+                                   mode='debug'))
+    db_session.commit()
+
+
+def run_worker(database_url, wal, number, saves, start, results):
+    experiment = setup(database_url, wal)
+    client = experiment.app.test_client()
+    uid = 'bench%d:bench' % number
+    trials = []
+    ok = failed = 0
+    start.wait()
+    for trial in range(saves):
+        trials.append({'current_trial': trial, 'response': 'x' * 200})
+        try:
+            saved = client.put('/sync/' + uid, data=json.dumps(
+                {'data': trials}), content_type='application/json')
+            loaded = client.get('/sync/' + uid)
+            if saved.status_code == 200 and loaded.status_code == 200:
+                ok += 1
+            else:
+                failed += 1
+        except Exception:
+            # "database is locked" surfaces as an OperationalError
+            failed += 1
+            experiment.db_session.rollback()
+    results.put((ok, failed))
+
+
+def benchmark(wal, workers, saves):
+    folder = tempfile.mkdtemp()
+    database_url = 'sqlite:///' + os.path.join(folder, 'bench.db')
+    try:
+        setup_process = multiprocessing.Process(
+            target=create_participants, args=(database_url, wal, workers))
+        setup_process.start()
+        setup_process.join()
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=run_worker,
+            args=(database_url, wal, number, saves, start, results))
+                     for number in range(workers)]
+        for process in processes:
+            process.start()
+        time.sleep(2)  # let every worker load the server first
+        began = time.time()
+        start.set()
+        totals = [results.get() for _ in processes]
+        elapsed = time.time() - began
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(folder)
+    ok = sum(result[0] for result in totals)
+    failed = sum(result[1] for result in totals)
+    return ok, failed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--saves', type=int, default=100)
+    args = parser.parse_args()
+    print '%d workers, %d saves and loads each' % (args.workers, args.saves)
+    for wal in [False, True]:
+        ok, failed, elapsed = benchmark(wal, args.workers, args.saves)
+        print 'sqlite_wal = %-5s  %6.1f saves/s  %d failed  (%.2fs)' % (
+            str(wal).lower(), ok / elapsed, failed, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import dateutil.tz
 
 from flask import jsonify
 import re as re
-from psiturk.psiturk_config import PsiturkConfig
+from psiturk.psiturk_config import get_config
 
 MYSQL_RESERVED_WORDS_CAP = [
     'ACCESSIBLE', 'ADD', 'ALL', 'ALTER', 'ANALYZE', 'AND', 'AS', 'ASC',
@@ -514,8 +514,7 @@ class MTurkServices(object):
             QualificationRequirements=quals)
 
         # Check the config file to see if notifications are wanted.
-        config = PsiturkConfig()
-        config.load_config()
+        config = get_config()
 
         try:
             url = config.get('Server Parameters', 'notification_url')
@@ -25,11 +25,9 @@ except ImportError:
 import webbrowser
 import sqlalchemy as sa
 
-from amt_services import MTurkServices, RDSServices
-from psiturk_org_services import PsiturkOrgServices, TunnelServices
-from psiturk_config import PsiturkConfig
+from psiturk_config import get_config
 from db import db_session, init_db
-from models import Participant
+from models import Participant, HitAd
 from utils import *
 
 class MTurkServicesWrapper():
@@ -37,10 +35,15 @@ class MTurkServicesWrapper():
     _cached_web_services = None
     _cached_dbs_services = None
     _cached_amt_services = None
+    _cached_tunnel = None
+
+    # The service modules import boto3 and friends, so they are only
+    # imported once a service is used
 
     @property
     def web_services(self):
         if not self._cached_web_services:
+            from psiturk_org_services import PsiturkOrgServices
             self._cached_web_services = PsiturkOrgServices(
                 self.config.get('psiTurk Access', 'psiturk_access_key_id'),
                 self.config.get('psiTurk Access', 'psiturk_secret_access_id'))
@@ -49,6 +52,7 @@ class MTurkServicesWrapper():
     @property
     def db_services(self):
         if not self._cached_dbs_services:
+            from amt_services import RDSServices
             self._cached_dbs_services = RDSServices(
                 self.config.get('AWS Access', 'aws_access_key_id'), \
                 self.config.get('AWS Access', 'aws_secret_access_key'),
@@ -58,9 +62,17 @@ class MTurkServicesWrapper():
     def set_web_services(self, web_services):
         self._cached_web_services = web_services
 
+    @property
+    def tunnel(self):
+        if not self._cached_tunnel:
+            from psiturk_org_services import TunnelServices
+            self._cached_tunnel = TunnelServices(self.config)
+        return self._cached_tunnel
+
     @property
     def amt_services(self):
         if not self._cached_amt_services:
+            from amt_services import MTurkServices
             self._cached_amt_services = MTurkServices(
                 self.config.get('AWS Access', 'aws_access_key_id'), \
                 self.config.get('AWS Access', 'aws_secret_access_key'),
@@ -70,16 +82,14 @@ class MTurkServicesWrapper():
     def __init__(self, config=None, web_services=None, tunnel=None, sandbox=None):
 
         if not config:
-            config = PsiturkConfig()
-            config.load_config()
+            config = get_config()
         self.config = config
 
         if web_services:
             self._cached_web_services = web_services
 
-        if not tunnel:
-            tunnel = TunnelServices(config)
-        self.tunnel = tunnel
+        if tunnel:
+            self._cached_tunnel = tunnel
 
         if not sandbox:
             sandbox = config.getboolean('Shell Parameters', 'launch_in_sandbox_mode')
@@ -291,7 +301,8 @@ class MTurkServicesWrapper():
 
     def _get_my_hitids(self):
         init_db()
-        my_hitids = [part.hitid for part in Participant.query.distinct(Participant.hitid)]
+        my_hitids = [hitid for (hitid,) in
+                     db_session.query(Participant.hitid).distinct()]
         return my_hitids
 
     def _get_hits(self, all_studies=False):
@@ -421,6 +432,8 @@ class MTurkServicesWrapper():
                     if not self.web_services.set_ad_hitid(ad_id, hit_id, int(self.sandbox)):
                         create_failed = True
                         fail_msg = "  Unable to update Ad on http://ad.psiturk.org to point at HIT."
+                    else:
+                        self.save_hit_ad(hit_id, ad_id)
                 else:
                     create_failed = True
                     fail_msg = "  Unable to create HIT on Amazon Mechanical Turk."
@@ -447,6 +460,18 @@ class MTurkServicesWrapper():
 
         return (hit_id, ad_id)
 
+    def save_hit_ad(self, hit_id, ad_id):
+        ''' Remember which ad belongs to a HIT, saving the experiment
+        server a call to the ad server when participants arrive. '''
+        try:
+            init_db()
+            db_session.merge(HitAd(hitid=hit_id, adid=str(ad_id)))
+            db_session.commit()
+        except sa.exc.SQLAlchemyError:
+            db_session.rollback()
+            print("*** Could not save the ad id for this HIT; the server "
+                  "will look it up on psiturk.org instead.")
+
     def create_psiturk_ad(self):
         # register with the ad server (psiturk.org/ad/register) using POST
         if os.path.exists('templates/ad.html'):
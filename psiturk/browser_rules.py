@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" This module decides which browsers may take part in an experiment,
+according to the `browser_exclude_rule` config option. """
+
+import threading
+from collections import OrderedDict, namedtuple
+
+from werkzeug.useragents import UserAgent
+
+# What the experiment server needs to know about a user agent string
+BrowserInfo = namedtuple('BrowserInfo',
+                         ['allowed', 'browser', 'platform', 'language'])
+
+# Rules naming a kind of device rather than part of the user agent string
+DEVICE_RULES = {
+    'mobile': 'is_mobile',
+    'tablet': 'is_tablet',
+    'touchcapable': 'is_touch_capable',
+    'pc': 'is_pc',
+    'bot': 'is_bot'
+}
+
+
+class BrowserRules(object):
+    """
+    A `browser_exclude_rule` string (e.g. "MSIE, mobile, tablet") compiled
+    into a matcher, with the verdicts for the most recently seen
+    `cache_size` user agent strings kept in memory.
+    """
+
+    def __init__(self, rule, cache_size=500):
+        self.rule = rule
+        rules = [part.strip() for part in rule.split(',') if part.strip()]
+        self.device_checks = [DEVICE_RULES[part] for part in rules
+                              if part in DEVICE_RULES]
+        self.exclude_safari = 'Safari' in rules or 'safari' in rules
+        self.substrings = [part for part in rules
+                           if part not in DEVICE_RULES and
+                           part not in ['Safari', 'safari']]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allows(self, user_agent_string):
+        ''' Whether the rules let this browser take part. '''
+        for substring in self.substrings:
+            if substring in user_agent_string:
+                return False
+        if self.exclude_safari and 'Safari' in user_agent_string and \
+                'Chrome' not in user_agent_string:
+            return False
+        if self.device_checks:
+            # user_agents is slow to import, and only needed for these
+            import user_agents
+            parsed = user_agents.parse(user_agent_string)
+            for check in self.device_checks:
+                if getattr(parsed, check):
+                    return False
+        return True
+
+    def classify(self, user_agent_string):
+        ''' BrowserInfo for a user agent string, from the cache if seen
+        recently. '''
+        with self.lock:
+            info = self.cache.pop(user_agent_string, None)
+            if info is not None:
+                self.cache[user_agent_string] = info
+                return info
+        agent = UserAgent(user_agent_string)
+        info = BrowserInfo(self.allows(user_agent_string), agent.browser,
+                           agent.platform, agent.language)
+        with self.lock:
+            self.cache[user_agent_string] = info
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return info
@@ -4,7 +4,10 @@ import argparse
 import sys
 import os
 from psiturk.version import version_number
-from psiturk.psiturk_org_services import ExperimentExchangeServices
+
+# What each command imports on startup, for --profile-startup
+SERVER_MODULES = ['psiturk.experiment_server', 'psiturk.experiment']
+SHELL_MODULES = ['psiturk.psiturk_shell']
 
 
 def process():
@@ -33,6 +36,7 @@ def install_from_exchange():
         experiment in the exchange'
     )
     args = parser.parse_args()
+    from psiturk.psiturk_org_services import ExperimentExchangeServices
     exp_exch = ExperimentExchangeServices()
     exp_exch.download_experiment(args.exp_id)
 
@@ -67,11 +71,18 @@ def launch_server():
     parser.add_argument(
         '-v', '--version', help='Print version number.', action="store_true"
     )
+    parser.add_argument(
+        '--profile-startup', help='List the slowest imports done on startup.',
+        action="store_true"
+    )
     args = parser.parse_args()
 
     # If requested version just print and quite
     if args.version:
         print version_number
+    elif args.profile_startup:
+        from psiturk.startup_profile import profile_startup
+        profile_startup(SERVER_MODULES)
     else:
         import psiturk.experiment_server as es
         es.launch()
@@ -90,6 +101,10 @@ def launch_shell():
         '-c', '--cabinmode', help='Launch psiturk in cabin (offline) mode',
         action="store_true"
     )
+    parser.add_argument(
+        '--profile-startup', help='List the slowest imports done on startup.',
+        action="store_true"
+    )
     script_group = parser.add_mutually_exclusive_group()
     script_group.add_argument(
         '-s', '--script', help='Run commands from a script file'
@@ -101,6 +116,9 @@ def launch_shell():
     # If requested version just print and quit
     if args.version:
         print version_number
+    elif args.profile_startup:
+        from psiturk.startup_profile import profile_startup
+        profile_startup(SHELL_MODULES)
     else:
         import psiturk.psiturk_shell as ps
         if args.script:
@@ -0,0 +1,851 @@
+# -*- coding: utf-8 -*-
+""" This module writes the trial, event and question data of the
+participants in the database to csv files, for download_datafiles. """
+
+import io
+import os
+import csv
+import json
+import heapq
+import urllib
+import shutil
+import datetime
+import tempfile
+import multiprocessing
+
+from db import db_session, engine
+from models import Participant, TrialData, EventData, QuestionData, \
+    normalized_data
+from models import NOT_ACCEPTED, ALLOCATED, STARTED, COMPLETED, SUBMITTED, \
+    CREDITED, QUITEARLY, BONUSED
+
+DATAFILES = ['trialdata', 'eventdata', 'questiondata']
+
+# Names accepted for the --status option of download_datafiles
+STATUSES = {
+    'not_accepted': NOT_ACCEPTED,
+    'allocated': ALLOCATED,
+    'started': STARTED,
+    'completed': COMPLETED,
+    'submitted': SUBMITTED,
+    'credited': CREDITED,
+    'quitearly': QUITEARLY,
+    'bonused': BONUSED
+}
+
+
+def parse_status(status):
+    ''' Status code for a status name (see STATUSES) or number. '''
+    if status.isdigit():
+        return int(status)
+    try:
+        return STATUSES[status.lower()]
+    except KeyError:
+        raise ValueError("unknown status '%s', use one of %s" % (
+            status, ', '.join(sorted(STATUSES))))
+
+
+def parse_date(date):
+    ''' datetime for a YYYY-MM-DD date. '''
+    try:
+        return datetime.datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError("dates are written YYYY-MM-DD, not '%s'" % date)
+
+
+def filter_participants(query, codeversion=None, statuses=None, mode=None,
+                        since=None, until=None):
+    '''
+    Narrow a query on Participant down to one code version, any of a list
+    of statuses, one mode, and/or those who began the HIT on or after
+    `since` and before `until`, in the database.
+    '''
+    if codeversion is not None:
+        query = query.filter(Participant.codeversion == codeversion)
+    if statuses:
+        query = query.filter(Participant.status.in_(statuses))
+    if mode is not None:
+        query = query.filter(Participant.mode == mode)
+    if since is not None:
+        query = query.filter(Participant.beginhit >= since)
+    if until is not None:
+        query = query.filter(Participant.beginhit < until)
+    return query
+
+
+def trial_rows(uniqueid, document):
+    return [(uniqueid, trial["current_trial"], trial["dateTime"],
+             json.dumps(trial["trialdata"]))
+            for trial in document.get("data", [])]
+
+
+def event_rows(uniqueid, document):
+    return [(uniqueid, event["eventtype"], event["interval"],
+             event["value"], event["timestamp"])
+            for event in document.get("eventdata", [])]
+
+
+def question_rows(uniqueid, document):
+    questiondata = document.get("questiondata", {})
+    return [(uniqueid, question, questiondata[question])
+            for question in questiondata]
+
+
+def participant_rows(query, batch_size):
+    '''
+    For each participant, parse their datastring once and yield their
+    uniqueid and the [trial rows, event rows, question rows] in it. The
+    participants are fetched `batch_size` at a time.
+    '''
+    query = query.with_entities(Participant.uniqueid, Participant.datastring)
+    for uniqueid, datastring in query.yield_per(batch_size):
+        try:
+            document = json.loads(datastring)
+        except (TypeError, ValueError):
+            # There was no data to return.
+            document = None
+        if not isinstance(document, dict):
+            yield uniqueid, [[], [], []]
+            continue
+        rows = []
+        for to_rows in [trial_rows, event_rows, question_rows]:
+            try:
+                rows.append(to_rows(uniqueid, document))
+            except (KeyError, TypeError, AttributeError):
+                print("Error reading record: %s" % uniqueid)
+                rows.append([])
+        yield uniqueid, rows
+
+
+def datastring_rows(query, batch_size):
+    ''' The rows of participant_rows(), without the uniqueids. '''
+    for _, rows in participant_rows(query, batch_size):
+        yield rows
+
+
+def table_rows(participants, batch_size, names=DATAFILES):
+    '''
+    Yield the rows of the normalized trial, event and question tables (or
+    those of them named) for the participants selected, as
+    ([trial row], [], []) and so on, fetched `batch_size` at a time.
+    '''
+    uniqueids = participants.with_entities(Participant.uniqueid).statement
+    if 'trialdata' in names:
+        trials = db_session.query(
+            TrialData.uniqueid, TrialData.current_trial, TrialData.datetime,
+            TrialData.payload).\
+            filter(TrialData.uniqueid.in_(uniqueids)).\
+            order_by(TrialData.uniqueid, TrialData.seq)
+        for row in trials.yield_per(batch_size):
+            yield [tuple(row)], [], []
+    if 'eventdata' in names:
+        events = db_session.query(
+            EventData.uniqueid, EventData.eventtype, EventData.interval,
+            EventData.value, EventData.timestamp).\
+            filter(EventData.uniqueid.in_(uniqueids)).\
+            order_by(EventData.uniqueid, EventData.seq)
+        for row in events.yield_per(batch_size):
+            yield [], [(row.uniqueid, row.eventtype, row.interval,
+                        json.loads(row.value), row.timestamp)], []
+    if 'questiondata' in names:
+        questions = db_session.query(
+            QuestionData.uniqueid, QuestionData.question,
+            QuestionData.response).\
+            filter(QuestionData.uniqueid.in_(uniqueids)).\
+            order_by(QuestionData.uniqueid, QuestionData.id)
+        for row in questions.yield_per(batch_size):
+            yield [], [], [(row.uniqueid, row.question,
+                            json.loads(row.response))]
+
+
+def write_datafiles(paths, participants, batch_size):
+    ''' Write the trial, event and question data of the participants
+    queried to the three files at paths (None to leave one out). '''
+    if normalized_data():
+        rows = table_rows(participants, batch_size)
+    else:
+        rows = datastring_rows(participants.order_by(Participant.uniqueid),
+                               batch_size)
+    files = [open(path or os.devnull, 'wb') for path in paths]
+    try:
+        writers = [csv.writer(datafile) for datafile in files]
+        for file_rows in rows:
+            for writer, datafile_rows in zip(writers, file_rows):
+                writer.writerows(datafile_rows)
+    finally:
+        for datafile in files:
+            datafile.close()
+
+
+def export_datafiles(directory='.', batch_size=100, jobs=1, columnar=False,
+                     **filters):
+    '''
+    Write trialdata.csv, eventdata.csv and questiondata.csv to directory
+    for the participants chosen by the filters (see filter_participants()),
+    in one pass over the database that only holds `batch_size` participants
+    in memory at a time. With more than one job, ranges of participants are
+    exported by a pool of that many processes and then joined in order, to
+    the same files. If columnar is set, the trials are written to a
+    columnar file instead of trialdata.csv; see export_trials_columnar().
+    Returns the number of participants chosen. Participants who join while
+    the export runs may or may not be in the files, and are counted if so.
+    '''
+    participants = filter_participants(Participant.query, **filters)
+    paths = [os.path.join(directory, name + '.csv') for name in DATAFILES]
+    if columnar:
+        export_trials_columnar(directory, participants, batch_size)
+        paths[0] = None
+    if jobs > 1:
+        return export_in_parallel(directory, paths, participants, batch_size,
+                                  jobs, filters)
+    write_datafiles(paths, participants, batch_size)
+    return participants.count()
+
+
+# Each job gets about this many ranges, so that one slow range does not
+# leave the other processes idle at the end
+CHUNKS_PER_JOB = 4
+
+
+def chunk_bounds(participants, chunk_size):
+    '''
+    (lower, upper) uniqueid ranges, lower bound included and upper bound
+    excluded, of about chunk_size participants each, in uniqueid order.
+    Between them they cover every uniqueid: each range ends where the next
+    starts, the first has no lower bound and the last no upper bound (None),
+    so participants added while the export runs fall into one of them.
+    '''
+    starts = []
+    uniqueids = participants.with_entities(Participant.uniqueid).\
+        order_by(Participant.uniqueid)
+    for number, (uniqueid,) in enumerate(uniqueids.yield_per(1000)):
+        if number % chunk_size == 0:
+            starts.append(uniqueid)
+    return zip([None] + starts[1:], starts[1:] + [None])
+
+
+def export_chunk(task):
+    ''' Export the participants from one range of uniqueids to numbered
+    part files of the data files named; run in a worker process. Returns
+    the paths (None for the files not named) and the number of participants
+    in the range. '''
+    directory, number, lower, upper, names, batch_size, filters = task
+    participants = filter_participants(Participant.query, **filters)
+    if lower is not None:
+        participants = participants.filter(Participant.uniqueid >= lower)
+    if upper is not None:
+        participants = participants.filter(Participant.uniqueid < upper)
+    paths = [os.path.join(directory, '%s.%06d.csv' % (name, number))
+             if name in names else None for name in DATAFILES]
+    try:
+        count = participants.count()
+        write_datafiles(paths, participants, batch_size)
+    finally:
+        db_session.remove()
+    return paths, count
+
+
+def export_in_parallel(directory, paths, participants, batch_size, jobs,
+                       filters):
+    ''' export_datafiles() for more than one job. The count returned is
+    what the ranges held when they were exported, which includes anyone
+    who joined after the ranges were worked out. '''
+    chunk_size = max(1, -(-participants.count() // (jobs * CHUNKS_PER_JOB)))
+    bounds = chunk_bounds(participants, chunk_size)
+    # Worker processes must open their own database connections rather
+    # than share the ones open here
+    db_session.remove()
+    engine.dispose()
+
+    names = [name for name, path in zip(DATAFILES, paths) if path]
+    parts_directory = tempfile.mkdtemp(dir=directory)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        tasks = [(parts_directory, number, lower, upper, names, batch_size,
+                  filters)
+                 for number, (lower, upper) in enumerate(bounds)]
+        # imap returns the parts in range order however the work is shared
+        count = 0
+        files = [open(path, 'wb') if path else None for path in paths]
+        try:
+            for part_paths, part_count in pool.imap(export_chunk, tasks):
+                count += part_count
+                for datafile, part_path in zip(files, part_paths):
+                    if datafile is None:
+                        continue
+                    with open(part_path, 'rb') as part:
+                        shutil.copyfileobj(part, datafile)
+                    os.remove(part_path)
+        finally:
+            for datafile in files:
+                if datafile is not None:
+                    datafile.close()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(parts_directory)
+    return count
+
+
+# Streaming one data file
+# =======================
+
+# Names of the columns of each data file, for the keys of JSON exports
+DATAFILE_FIELDS = {
+    'trialdata': ['uniqueid', 'current_trial', 'dateTime', 'trialdata'],
+    'eventdata': ['uniqueid', 'eventtype', 'interval', 'value', 'timestamp'],
+    'questiondata': ['uniqueid', 'question', 'response']
+}
+
+
+def datafile_rows(name, participants, batch_size=100):
+    ''' Yield the rows of one data file for the participants queried, as
+    export_datafiles() writes them. '''
+    index = DATAFILES.index(name)
+    if normalized_data():
+        rows = table_rows(participants, batch_size, [name])
+    else:
+        rows = datastring_rows(participants.order_by(Participant.uniqueid),
+                               batch_size)
+    for file_rows in rows:
+        for row in file_rows[index]:
+            yield row
+
+
+def csv_chunks(rows, chunk_rows=500):
+    ''' Rows as csv text, `chunk_rows` rows per piece. '''
+    buffer = io.BytesIO()
+    writer = csv.writer(buffer)
+    for number, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if number % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(name, rows, chunk_rows=500):
+    ''' Rows of a data file as one JSON object per line, `chunk_rows`
+    lines per piece. The trial data is included as JSON, not text. '''
+    fields = DATAFILE_FIELDS[name]
+    lines = []
+    for row in rows:
+        record = dict(zip(fields, row))
+        if name == 'trialdata':
+            record['trialdata'] = json.loads(record['trialdata'])
+        lines.append(json.dumps(record) + '\n')
+        if len(lines) == chunk_rows:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+# Incremental exports
+# ===================
+
+# Where export_incremental() keeps the rows of each run, and what it
+# exported last time
+SHARDS_FOLDER = 'datafiles'
+WATERMARK_FILE = 'watermark.json'
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# How far before the watermark each run looks for changes committed late
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+# Lists the participants read by a run, whose rows in older shards it
+# replaces, and those of them it wrote
+SHARD_UNIQUEIDS = 'uniqueids.json'
+# Once there are more shards than this they are merged into one, so that
+# the number of files stays bounded
+COMPACT_AFTER = 24
+
+
+def load_watermark(shards):
+    ''' The watermark file of the last incremental export, or {}. '''
+    try:
+        with open(os.path.join(shards, WATERMARK_FILE)) as watermark_file:
+            return json.load(watermark_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def shard_paths(folder):
+    ''' The three data files of one shard. '''
+    return [os.path.join(folder, name + '.csv') for name in DATAFILES]
+
+
+def write_shard(shards, watermark, read, written):
+    ''' Start a new, empty shard folder and record which participants
+    it holds. Returns the paths of its data files. '''
+    run = '%06d' % watermark.get('next_run', 1)
+    watermark['next_run'] = int(run) + 1
+    watermark.setdefault('runs', []).append(run)
+    folder = os.path.join(shards, run)
+    os.makedirs(folder)
+    with open(os.path.join(folder, SHARD_UNIQUEIDS), 'w') as uniqueids_file:
+        json.dump({'read': sorted(read), 'written': sorted(written)},
+                  uniqueids_file)
+    return shard_paths(folder)
+
+
+def newest_shards(shards, runs):
+    ''' Map each participant to the newest of the runs that read them, and
+    return it with the participants that run wrote. '''
+    newest = {}
+    written = set()
+    for run in runs:
+        with open(os.path.join(shards, run, SHARD_UNIQUEIDS)) as uniqueids:
+            listed = json.load(uniqueids)
+        for uniqueid in listed['read']:
+            newest[uniqueid] = run
+            written.discard(uniqueid)
+        written.update(listed['written'])
+    return newest, written
+
+
+def shard_rows(path, run, order, newest):
+    ''' The rows of one shard data file that are not replaced by a newer
+    shard, keyed for merging in uniqueid order. '''
+    with open(path, 'rb') as shard:
+        for number, row in enumerate(csv.reader(shard)):
+            if newest.get(row[0].decode('utf-8')) == run:
+                yield row[0], order, number, row
+
+
+def merge_shards(shards, runs, paths):
+    '''
+    Write the rows of the shards of the runs to the three data files at
+    paths, each participant's from the newest shard that read them, in
+    uniqueid order. Only one row of each shard is held in memory at a time.
+    Returns the number of participants written.
+    '''
+    newest, written = newest_shards(shards, runs)
+    for index, path in enumerate(paths):
+        rows = heapq.merge(*[
+            shard_rows(shard_paths(os.path.join(shards, run))[index], run,
+                       order, newest)
+            for order, run in enumerate(runs)])
+        with open(path, 'wb') as datafile:
+            writer = csv.writer(datafile)
+            for _, _, _, row in rows:
+                writer.writerow(row)
+    return len(written)
+
+
+def compact_shards(shards, watermark):
+    ''' Replace all the shards with one holding the same rows. '''
+    runs = watermark['runs']
+    newest, written = newest_shards(shards, runs)
+    watermark['runs'] = []
+    merge_shards(shards, runs,
+                 write_shard(shards, watermark, newest, written))
+    for run in runs:
+        shutil.rmtree(os.path.join(shards, run))
+
+
+def export_incremental(directory='.', batch_size=100,
+                       overlap=WATERMARK_OVERLAP, **filters):
+    '''
+    Like export_datafiles(), but only reads the participants whose data or
+    status changed (see Participant.last_modified) since the last time it
+    was run in this directory. Their rows are written to a new numbered
+    folder (a shard) under datafiles/, and replace those of the same
+    participants in older shards, which is how a participant who no longer
+    matches the filters is dropped. The first run, or one with different
+    filters, exports everyone. Nothing else is rewritten, so a run costs
+    about as much as the changes since the last one; merge_incremental()
+    puts the shards together into the three data files. Returns the number
+    of participants read from the database and the number of them written.
+
+    last_modified is stamped by each server's clock before the change is
+    committed, so a change can show up after the export read later ones.
+    Every run therefore looks back `overlap` (a timedelta) before the
+    latest change it read last time, and reads again those in that window
+    whose last_modified is not the one it exported. Changes committed more
+    than `overlap` after they were stamped, or from a server whose clock is
+    that far behind, can still be missed.
+    '''
+    shards = os.path.join(directory, SHARDS_FOLDER)
+    watermark = load_watermark(shards)
+    candidates = Participant.query
+    recent = {}
+    since = None
+    if watermark.get('filters') == repr(sorted(filters.items())) and \
+            watermark.get('last_modified'):
+        since = datetime.datetime.strptime(watermark['last_modified'],
+                                           WATERMARK_FORMAT)
+        recent = watermark['recent']
+        candidates = candidates.filter(
+            Participant.last_modified >= since - overlap)
+    else:
+        if os.path.exists(shards):
+            shutil.rmtree(shards)
+        os.makedirs(shards)
+        watermark = {'filters': repr(sorted(filters.items()))}
+
+    stamps = dict(candidates.with_entities(Participant.uniqueid,
+                                           Participant.last_modified))
+    # Those in the window that are as last exported are left alone
+    unchanged = [uniqueid for uniqueid, last_modified in stamps.items()
+                 if last_modified is not None and recent.get(uniqueid) ==
+                 last_modified.strftime(WATERMARK_FORMAT)]
+    changed = candidates
+    if unchanged:
+        changed = changed.filter(~Participant.uniqueid.in_(unchanged))
+    read = set(stamps) - set(unchanged)
+    if not read:
+        return 0, 0
+    chosen = filter_participants(changed, **filters)
+    written = [uniqueid for (uniqueid,) in
+               chosen.with_entities(Participant.uniqueid)]
+    write_datafiles(write_shard(shards, watermark, read, written), chosen,
+                    batch_size)
+    if len(watermark['runs']) > COMPACT_AFTER:
+        compact_shards(shards, watermark)
+
+    # Participants from before last_modified was added have none
+    latest = max([last_modified
+                  for last_modified in stamps.values() + [since]
+                  if last_modified is not None] or [None])
+    if latest is not None:
+        watermark['last_modified'] = latest.strftime(WATERMARK_FORMAT)
+        watermark['recent'] = dict(
+            (uniqueid, last_modified.strftime(WATERMARK_FORMAT))
+            for uniqueid, last_modified in stamps.items()
+            if last_modified is not None and
+            last_modified >= latest - overlap)
+    with open(os.path.join(shards, WATERMARK_FILE), 'w') as watermark_file:
+        json.dump(watermark, watermark_file)
+    return len(read), len(written)
+
+
+def merge_incremental(directory='.'):
+    '''
+    Put the shards written by export_incremental() in directory together
+    into trialdata.csv, eventdata.csv and questiondata.csv there, the same
+    as export_datafiles() would have written them. Returns the number of
+    participants in them.
+    '''
+    shards = os.path.join(directory, SHARDS_FOLDER)
+    return merge_shards(shards, load_watermark(shards).get('runs', []),
+                        shard_paths(directory))
+
+
+# Columnar trial data
+# ===================
+
+# Column types, each of which can hold the values of the ones before it
+COLUMN_TYPES = ['bool', 'int', 'float', 'string']
+
+
+def column_type(value):
+    ''' Column type needed for a value, or None for a missing value. '''
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, long)):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'string'
+
+
+def flatten_trialdata(trialdata, prefix='trialdata'):
+    '''
+    {column name: value} for a trial's data, with nested objects flattened
+    to dotted names ("trialdata.stimulus.color") and lists recorded with
+    psiturk.recordTrialData([...]) numbered ("trialdata.0"). Lists inside
+    the data are kept as JSON text.
+    '''
+    if isinstance(trialdata, list) and prefix == 'trialdata':
+        trialdata = dict((str(number), value)
+                         for number, value in enumerate(trialdata))
+    if not isinstance(trialdata, dict):
+        if isinstance(trialdata, list):
+            trialdata = json.dumps(trialdata)
+        return {prefix: trialdata}
+    columns = {}
+    for key, value in trialdata.iteritems():
+        columns.update(flatten_trialdata(value, '%s.%s' % (prefix, key)))
+    return columns
+
+
+def trial_records(participants, batch_size):
+    ''' (uniqueid, current trial, time, flattened trial data) for every
+    trial of the participants queried, in uniqueid order. '''
+    if normalized_data():
+        uniqueids = participants.with_entities(Participant.uniqueid).statement
+        trials = db_session.query(
+            TrialData.uniqueid, TrialData.current_trial, TrialData.datetime,
+            TrialData.payload).\
+            filter(TrialData.uniqueid.in_(uniqueids)).\
+            order_by(TrialData.uniqueid, TrialData.seq)
+        for row in trials.yield_per(batch_size):
+            yield (row.uniqueid, row.current_trial, row.datetime,
+                   flatten_trialdata(json.loads(row.payload)))
+        return
+    query = participants.order_by(Participant.uniqueid).\
+        with_entities(Participant.uniqueid, Participant.datastring)
+    for uniqueid, datastring in query.yield_per(batch_size):
+        try:
+            trials = json.loads(datastring)["data"]
+        except (TypeError, ValueError, KeyError):
+            continue
+        for trial in trials:
+            if isinstance(trial, dict):
+                yield (uniqueid, trial.get("current_trial"),
+                       trial.get("dateTime"),
+                       flatten_trialdata(trial.get("trialdata")))
+
+
+def scan_trials(records):
+    '''
+    Look over the trials in records once, for what the columnar files
+    need to know up front: the trial_schema(), the number of trials, and
+    how many trials have a value for each column.
+    '''
+    types = {}
+    given = {}
+    rows = 0
+    for uniqueid, current_trial, date_time, columns in records:
+        rows += 1
+        for name, value in columns.iteritems():
+            new_type = column_type(value)
+            old_type = types.get(name)
+            if old_type is None or (new_type is not None and
+                                    COLUMN_TYPES.index(new_type) >
+                                    COLUMN_TYPES.index(old_type)):
+                types[name] = new_type
+        values = dict(columns, uniqueid=uniqueid,
+                      current_trial=current_trial, dateTime=date_time)
+        for name, value in values.iteritems():
+            if value is None:
+                continue
+            given[name] = given.get(name, 0) + 1
+    schema = [('uniqueid', 'string'), ('current_trial', 'int'),
+              ('dateTime', 'int')] + \
+        [(name, types[name] or 'string') for name in sorted(types)]
+    return schema, rows, given
+
+
+def trial_schema(records):
+    '''
+    [(column name, column type)] holding every trial: uniqueid,
+    current_trial and dateTime, then the union of the flattened trial data
+    columns in name order, each with the narrowest type that holds all of
+    its values (text if no value was ever recorded).
+    '''
+    return scan_trials(records)[0]
+
+
+def column_value(value, kind):
+    ''' A value converted to a column's type; None stays missing. '''
+    if value is None:
+        return None
+    if kind == 'string':
+        if isinstance(value, basestring):
+            return value
+        return json.dumps(value)
+    return {'bool': bool, 'int': int, 'float': float}[kind](value)
+
+
+def trial_columns(records, schema):
+    ''' The trials in records as {column name: [values]}, with the values
+    converted to the schema's types. '''
+    names = [name for name, _ in schema]
+    kinds = dict(schema)
+    columns = dict((name, []) for name in names)
+    for uniqueid, current_trial, date_time, data in records:
+        values = dict(data, uniqueid=uniqueid, current_trial=current_trial,
+                      dateTime=date_time)
+        for name in names:
+            columns[name].append(column_value(values.get(name), kinds[name]))
+    return columns
+
+
+def columnar_format():
+    ''' "parquet" if pyarrow is installed, otherwise "npy" if numpy is. '''
+    try:
+        __import__('imp').find_module('pyarrow')
+        return 'parquet'
+    except ImportError:
+        pass
+    try:
+        __import__('imp').find_module('numpy')
+        return 'npy'
+    except ImportError:
+        raise ImportError("Columnar export needs the `pyarrow` (or "
+                          "`numpy`) python package.  Try `pip install "
+                          "pyarrow`.")
+
+
+# What export_trials_columnar() writes in each format
+COLUMNAR_FILES = {'parquet': 'trialdata.parquet', 'npy': 'trialdata'}
+# Names of the columns of a trialdata folder of .npy files, in order
+NPY_COLUMNS_FILE = 'columns.json'
+# Text columns are stored as their UTF-8 bytes one after the other, with
+# this file of where each value starts (and one more entry, where the last
+# one ends)
+NPY_OFFSETS_SUFFIX = '.offsets'
+
+
+def export_trials_columnar(directory, participants, batch_size=100,
+                           file_format=None):
+    '''
+    Write the trials of the participants queried to trialdata.parquet
+    (with pyarrow), or to a trialdata folder of one .npy file per column
+    (with numpy), with one typed column per trial data field; see
+    trial_schema(). The database is read twice, once to lay out the
+    columns and once to write them, `batch_size` participants' trials at a
+    time, so trials saved in between may be left out. In Parquet missing
+    values are nulls. The .npy files can be memory-mapped; in them missing
+    numbers are NaN (in float columns) and missing text is "". Text
+    columns take two files, see npy_strings().
+    Returns the path written.
+    '''
+    file_format = file_format or columnar_format()
+    path = os.path.join(directory, COLUMNAR_FILES[file_format])
+    if file_format == 'parquet':
+        schema = trial_schema(trial_records(participants, batch_size))
+        write_parquet(path, participants, batch_size, schema)
+    else:
+        write_npy(path, participants, batch_size)
+    return path
+
+
+def batches(records, size):
+    ''' Lists of up to size records. '''
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_parquet(path, participants, batch_size, schema):
+    import pyarrow
+    import pyarrow.parquet
+    types = {'bool': pyarrow.bool_(), 'int': pyarrow.int64(),
+             'float': pyarrow.float64(), 'string': pyarrow.string()}
+    arrow_schema = pyarrow.schema([(name, types[kind])
+                                   for name, kind in schema])
+    writer = pyarrow.parquet.ParquetWriter(path, arrow_schema)
+    try:
+        # about batch_size participants' worth of trials per row group
+        for batch in batches(trial_records(participants, batch_size),
+                             batch_size * 100):
+            columns = trial_columns(batch, schema)
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(columns[name], type=types[kind])
+                 for name, kind in schema],
+                schema=arrow_schema))
+    finally:
+        writer.close()
+
+
+def npy_path(folder, name, suffix=''):
+    ''' File holding one column in a folder written by write_npy(), or
+    with suffix NPY_OFFSETS_SUFFIX, the offsets of a text column. '''
+    return os.path.join(folder, urllib.quote(name, safe='') + suffix +
+                        '.npy')
+
+
+def npy_strings(folder, name):
+    ''' Yield the values of a text column written by write_npy(), read
+    from the memory-mapped files as they are used. '''
+    import numpy
+    data = numpy.load(npy_path(folder, name), mmap_mode='r')
+    offsets = numpy.load(npy_path(folder, name, NPY_OFFSETS_SUFFIX),
+                         mmap_mode='r')
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        yield data[start:end].tostring().decode('utf-8')
+
+
+def write_npy_bytes(path, data_file, size):
+    ''' Write the size bytes of the open data_file to path as a .npy
+    array of uint8. '''
+    import numpy
+    from numpy.lib import format as npy_format
+    with open(path, 'wb') as npy_file:
+        npy_format.write_array_header_1_0(npy_file, {
+            'descr': npy_format.dtype_to_descr(numpy.dtype(numpy.uint8)),
+            'fortran_order': False, 'shape': (size,)})
+        data_file.seek(0)
+        shutil.copyfileobj(data_file, npy_file)
+
+
+def write_npy(folder, participants, batch_size):
+    import numpy
+    from numpy.lib.format import open_memmap
+    schema, rows, given = scan_trials(
+        trial_records(participants, batch_size))
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    # Each numeric column, and the offsets of each text column, is laid out
+    # full size on disk and filled in batch by batch, so only one batch of
+    # trials is held in memory. Text is appended to a scratch file, as its
+    # size is only known at the end, and copied into a .npy file after.
+    arrays = []
+    for name, kind in schema:
+        if kind == 'string':
+            arrays.append((open_memmap(
+                npy_path(folder, name, NPY_OFFSETS_SUFFIX), mode='w+',
+                dtype=numpy.int64, shape=(rows + 1,)),
+                tempfile.TemporaryFile(dir=folder)))
+            continue
+        if given.get(name, 0) < rows:
+            dtype = float
+        else:
+            dtype = {'bool': bool, 'int': numpy.int64, 'float': float}[kind]
+        if rows:
+            arrays.append(open_memmap(npy_path(folder, name), mode='w+',
+                                      dtype=dtype, shape=(rows,)))
+        else:
+            # an empty file cannot be memory-mapped
+            numpy.save(npy_path(folder, name), numpy.empty(0, dtype))
+            arrays.append(None)
+    written = 0
+    if rows:
+        for batch in batches(trial_records(participants, batch_size),
+                             batch_size * 100):
+            # trials saved since the columns were laid out are left out
+            batch = batch[:rows - written]
+            columns = trial_columns(batch, schema)
+            for (name, kind), array in zip(schema, arrays):
+                if kind != 'string':
+                    array[written:written + len(batch)] = [
+                        numpy.nan if value is None else value
+                        for value in columns[name]]
+                    continue
+                offsets, data_file = array
+                values = [u'' if value is None else value
+                          for value in columns[name]]
+                values = [value.encode('utf-8')
+                          if isinstance(value, unicode) else value
+                          for value in values]
+                offsets[written + 1:written + 1 + len(batch)] = \
+                    offsets[written] + \
+                    numpy.cumsum([len(value) for value in values])
+                data_file.write(''.join(values))
+            written += len(batch)
+            if written == rows:
+                break
+    for (name, kind), array in zip(schema, arrays):
+        if kind == 'string':
+            offsets, data_file = array
+            offsets[0] = 0
+            offsets.flush()
+            write_npy_bytes(npy_path(folder, name), data_file,
+                            int(offsets[rows]))
+            data_file.close()
+        elif array is not None:
+            array.flush()
+    with open(os.path.join(folder, NPY_COLUMNS_FILE), 'w') as columns_file:
+        json.dump([name for name, _ in schema], columns_file)
@@ -1,11 +1,10 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
-from psiturk_config import PsiturkConfig
+from psiturk_config import get_config
 import re, os
 
-config = PsiturkConfig()
-config.load_config()
+config = get_config()
 
 r = re.compile("OPENSHIFT_(.+)_DB_URL") # Might be MYSQL or POSTGRESQL
 matches = filter(r.match, os.environ)
@@ -26,7 +25,33 @@ if 'mysql://' in DATABASE.lower():
 	# the pymysql package
 	DATABASE = DATABASE.replace('mysql://', 'mysql+pymysql://')
 
-engine = create_engine(DATABASE, echo=False, pool_recycle=3600) 
+if DATABASE.lower().startswith('sqlite'):
+    # sqlite connections are not pooled in the same way, so the pool
+    # options do not apply
+    engine = create_engine(DATABASE, echo=False)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        ''' Let several server workers write to the file at once: a
+        writer waits for the lock instead of failing with "database is
+        locked", and with `sqlite_wal` readers do not block the writer. '''
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA busy_timeout = %d' % config.getint(
+            'Database Parameters', 'sqlite_busy_timeout'))
+        if config.getboolean('Database Parameters', 'sqlite_wal'):
+            cursor.execute('PRAGMA journal_mode = WAL')
+            # safe with WAL; only the last commits can be lost, and only
+            # if the machine itself goes down
+            cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.close()
+else:
+    engine = create_engine(
+        DATABASE, echo=False, pool_recycle=3600,
+        pool_size=config.getint('Database Parameters', 'pool_size'),
+        max_overflow=config.getint('Database Parameters', 'max_overflow'),
+        pool_pre_ping=config.getboolean('Database Parameters',
+                                        'pool_pre_ping'))
+
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
@@ -37,3 +62,21 @@ Base.query = db_session.query_property()
 def init_db():
     #print "Initalizing db if necessary."
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+def add_missing_columns():
+    """
+    create_all() leaves existing tables alone, so add any nullable columns
+    that have been declared on the models since the tables were created.
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        existing = [column['name'] for column in
+                    inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                quote(table.name), quote(column.name),
+                column.type.compile(dialect=engine.dialect)))
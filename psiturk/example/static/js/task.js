@@ -183,6 +183,7 @@ var Questionnaire = function() {
 		reprompt = setTimeout(prompt_resubmit, 10000);
 		
 		psiTurk.saveData({
+			flush: true,
 			success: function() {
 			    clearInterval(reprompt); 
                 psiTurk.computeBonus('compute_bonus', function(){
@@ -202,6 +203,7 @@ var Questionnaire = function() {
 	$("#next").click(function () {
 	    record_responses();
 	    psiTurk.saveData({
+            flush: true,
             success: function(){
                 psiTurk.computeBonus('compute_bonus', function() { 
                 	psiTurk.completeHIT(); // when finished saving compute bonus, the quit
@@ -6,11 +6,12 @@ import sys
 import datetime
 import logging
 from random import choice
-import user_agents
-import string
-import requests
 import re
 import json
+import atexit
+import zlib
+import hashlib
+import mimetypes
 
 try:
     from collections import Counter
@@ -19,20 +20,29 @@ except ImportError:
 
 # Setup flask
 from flask import Flask, render_template, render_template_string, request, \
-    jsonify
+    jsonify, has_request_context, make_response, url_for, send_from_directory, \
+    g, Response, stream_with_context
 
 # Setup database
 from db import db_session, init_db
-from models import Participant
-from sqlalchemy import or_, exc
-
-from psiturk_config import PsiturkConfig
+from models import Participant, ConditionCount, WorkerState, HitAd, \
+    save_data_rows, data_hash, transition, normalized_data
+from models import NOT_ACCEPTED, ALLOCATED, STARTED, COMPLETED, SUBMITTED, \
+    CREDITED, QUITEARLY, BONUSED
+from sqlalchemy import or_, and_, exists, exc, func
+from sqlalchemy.orm import undefer
+
+from psiturk_config import get_config
 from experiment_errors import ExperimentError, InvalidUsage
-from psiturk.user_utils import nocache
+from psiturk.user_utils import nocache, PsiTurkAuthorization
+from write_buffer import WriteBehindBuffer
+from static_assets import load_manifest, is_current, MANIFEST_FILE
+from browser_rules import BrowserRules
+from data_export import DATAFILES, filter_participants, parse_status, \
+    parse_date, datafile_rows, csv_chunks, ndjson_chunks
 
 # Setup config
-CONFIG = PsiturkConfig()
-CONFIG.load_config()
+CONFIG = get_config()
 
 # Setup logging
 if 'ON_HEROKU' in os.environ:
@@ -47,16 +57,6 @@ LOG_LEVEL = LOG_LEVELS[CONFIG.getint('Server Parameters', 'loglevel')]
 logging.basicConfig(filename=LOG_FILE_PATH, format='%(asctime)s %(message)s',
                     level=LOG_LEVEL)
 
-# Status codes
-NOT_ACCEPTED = 0
-ALLOCATED = 1
-STARTED = 2
-COMPLETED = 3
-SUBMITTED = 4
-CREDITED = 5
-QUITEARLY = 6
-BONUSED = 7
-
 
 # Let's start
 # ===========
@@ -67,6 +67,46 @@ app.config.update(SEND_FILE_MAX_AGE_DEFAULT=10)
 app.secret_key = CONFIG.get('Server Parameters', 'secret_key')
 app.logger.info("Secret key: " + app.secret_key)
 
+# Options read while serving participants are parsed once, here
+CONFIG.refresh_settings(os.path.join(app.root_path, 'conditions.json'))
+
+# Fingerprinted copies of the static files, made with `psiturk build_static`
+STATIC_MANIFEST = load_manifest(os.path.join(app.root_path, MANIFEST_FILE))
+STATIC_BUILT = set(STATIC_MANIFEST.values())
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# Whether each static file was unchanged since the build, when last checked
+STATIC_CHECKED = {}
+
+@app.template_global()
+def static_url(filename):
+    ''' URL of a static file, fingerprinted if `psiturk build_static` has
+    been run since it last changed. A file edited after the build gets its
+    plain /static/ URL, so participants are never sent the old copy. '''
+    built = STATIC_MANIFEST.get(filename)
+    if built is None or not is_current(app.static_folder, filename, built,
+                                       STATIC_CHECKED):
+        built = filename
+    return url_for('static', filename=built)
+
+def send_static(filename):
+    ''' Serve static files; fingerprinted ones never change, so browsers
+    may cache them for good, gzipped when possible '''
+    if filename not in STATIC_BUILT:
+        return app.send_static_file(filename)
+    compressed = os.path.join(app.static_folder, filename + '.gz')
+    if 'gzip' in request.accept_encodings and os.path.exists(compressed):
+        resp = send_from_directory(app.static_folder, filename + '.gz',
+                                   mimetype=mimetypes.guess_type(filename)[0])
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = app.send_static_file(filename)
+    resp.vary.add('Accept-Encoding')
+    resp.headers['Cache-Control'] = 'public, max-age=%d, immutable' % \
+        STATIC_MAX_AGE
+    return resp
+
+app.view_functions['static'] = send_static
+
 
 
 # Serving warm, fresh, & sweet custom, user-provided routes
@@ -89,6 +129,11 @@ else:
 init_db()
 
 
+def gzip_data(data, level=6):
+    ''' Compress data in gzip format '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
 # Read psiturk.js file into memory
 PSITURK_JS_FILE = os.path.join(os.path.dirname(__file__), \
     "psiturk_js/psiturk.js")
@@ -99,14 +144,22 @@ if os.path.exists(PSITURK_JS_FILE):
 else:
     PSITURK_JS_CODE = "alert('psiturk.js file not found!');"
 
+# Render it once, and keep a gzipped copy and ETags for both, so that
+# browsers can cache it and only revalidate once the cache expires
+with app.app_context():
+    PSITURK_JS = render_template_string(
+        PSITURK_JS_CODE.decode('utf-8')).encode('utf-8')
+PSITURK_JS_ETAG = hashlib.sha1(PSITURK_JS).hexdigest()
+PSITURK_JS_GZIP = gzip_data(PSITURK_JS, 9)
+PSITURK_JS_MAX_AGE = 24 * 60 * 60
+
 
 @app.errorhandler(ExperimentError)
 def handle_exp_error(exception):
     """Handle errors by sending an error page."""
     app.logger.error(
         "%s (%s) %s", exception.value, exception.errornum, str(dict(request.args)))
-    return exception.error_page(request, CONFIG.get('HIT Configuration',
-                                                    'contact_email_on_error'))
+    return exception.error_page(request, CONFIG.settings.contact_email_on_error)
 
 # for use with API errors
 @app.errorhandler(InvalidUsage)
@@ -121,11 +174,63 @@ def shutdown_session(_=None):
     ''' Shut down session route '''
     db_session.remove()
 
+# JSON responses smaller than this are not worth gzipping
+GZIP_MIN_SIZE = 1024
+# Added to the ETag of a gzipped response, so that caches tell it apart
+# from the uncompressed one
+GZIP_ETAG_SUFFIX = '-gzip'
+
+@app.after_request
+def compress_response(response):
+    ''' Gzip large JSON responses for clients that accept it '''
+    if response.mimetype != 'application/json' or \
+            response.status_code != 200 or response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if 'gzip' not in request.accept_encodings or len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip_data(data))
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + GZIP_ETAG_SUFFIX, weak)
+    return response
+
+def request_body():
+    ''' Body of the current request, gunzipped if sent with
+    Content-Encoding: gzip '''
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding == 'identity':
+        return request.data
+    if encoding != 'gzip':
+        raise InvalidUsage('unsupported Content-Encoding: %s' % encoding,
+                           status_code=415)
+    try:
+        return zlib.decompress(request.data, 16 + zlib.MAX_WBITS)
+    except zlib.error:
+        raise InvalidUsage('request body is not valid gzip data')
+
 
 # Experiment counterbalancing code
 # ================================
 
-def get_random_condcount(mode):
+# How often each server worker recounts conditions from the participant
+# table, which is what lets participants past cutoff_time drop out
+CONDCOUNT_SWEEP_INTERVAL = datetime.timedelta(minutes=1)
+# Times to retry a condition claim that lost a race to another worker
+CONDCOUNT_CLAIM_ATTEMPTS = 5
+# (codeversion, mode) -> time of this worker's last recount
+LAST_CONDCOUNT_SWEEP = {}
+
+def get_counted_after():
+    """ Participants who began before this and have not finished no longer
+    count towards their condition. """
+    cutofftime = datetime.timedelta(minutes=-CONFIG.settings.cutoff_time)
+    return datetime.datetime.now() + cutofftime
+
+def count_conditions(mode, keys):
     """
     HITs can be in one of three states:
         - jobs that are finished
@@ -135,46 +240,156 @@ def get_random_condcount(mode):
     or any tasks not finished that were started in the last cutoff_time
     minutes, as specified in the cutoff_time variable in the config file.
 
-    Returns a tuple: (cond, condition)
+    Returns a Counter of (cond, counterbalance) -> participants
     """
-    cutofftime = datetime.timedelta(minutes=-CONFIG.getint('Server Parameters',
-                                                           'cutoff_time'))
-    starttime = datetime.datetime.now() + cutofftime
-
-    try: 
-        conditions = json.load(open(os.path.join(app.root_path, 'conditions.json')))
-        numconds = len(conditions.keys())
-        numcounts = 1
-    except IOError as e:
-        numconds = CONFIG.getint('Task Parameters', 'num_conds')
-        numcounts = CONFIG.getint('Task Parameters', 'num_counters')
-
-    participants = Participant.query.\
+    starttime = get_counted_after()
+    condcounts = db_session.query(
+            Participant.cond, Participant.counterbalance,
+            func.count(Participant.uniqueid)).\
         filter(Participant.codeversion == \
-               CONFIG.get('Task Parameters', 'experiment_code_version')).\
+               CONFIG.settings.experiment_code_version).\
         filter(Participant.mode == mode).\
         filter(or_(Participant.status == COMPLETED,
                    Participant.status == CREDITED,
                    Participant.status == SUBMITTED,
                    Participant.status == BONUSED,
-                   Participant.beginhit > starttime)).all()
+                   Participant.beginhit > starttime)).\
+        group_by(Participant.cond, Participant.counterbalance)
+    counts = Counter()
+    for key in keys:
+        counts[key] = 0
+    for cond, counterbalance, count in condcounts:
+        if (cond, counterbalance) in counts:
+            counts[(cond, counterbalance)] += count
+    return counts
+
+def read_condcounts(slots, keys):
+    """ (cond, counterbalance) -> count of the condition count rows queried
+    for keys; keys without a row are left out. """
     counts = Counter()
-    for cond in range(numconds):
-        for counter in range(numcounts):
-            counts[(cond, counter)] = 0
-    for participant in participants:
-        condcount = (participant.cond, participant.counterbalance)
-        if condcount in counts:
-            counts[condcount] += 1
-    mincount = min(counts.values())
-    minima = [hsh for hsh, count in counts.iteritems() if count == mincount]
-    chosen = choice(minima)
-    #conds += [ 0 for _ in range(1000) ]
-    #conds += [ 1 for _ in range(1000) ]
+    for row in slots.with_entities(ConditionCount.cond,
+                                   ConditionCount.counterbalance,
+                                   ConditionCount.count):
+        if (row.cond, row.counterbalance) in keys:
+            counts[(row.cond, row.counterbalance)] = row.count
+    return counts
+
+def sweep_condcounts(mode, keys):
+    """
+    Bring the condition count table in line with a fresh count of the
+    participant table, dropping participants who have passed cutoff_time,
+    and add the rows of conditions it has none for. A count is only replaced
+    if it is still what was read, so a claim made on another server worker
+    in the meantime is not lost (that row waits for the next sweep), and
+    workers sweeping at the same time do not undo each other.
+    """
+    codeversion = CONFIG.settings.experiment_code_version
+    slots = ConditionCount.query.filter_by(codeversion=codeversion, mode=mode)
+    stored = read_condcounts(slots, keys)
+    counts = count_conditions(mode, keys)
+    for (cond, counter), count in counts.iteritems():
+        if (cond, counter) not in stored:
+            db_session.add(ConditionCount(codeversion=codeversion, mode=mode,
+                                          cond=cond, counterbalance=counter,
+                                          count=count))
+            try:
+                db_session.commit()
+            except exc.IntegrityError:
+                # another worker created the row first; its count will do
+                db_session.rollback()
+        elif stored[(cond, counter)] != count:
+            slots.filter_by(cond=cond, counterbalance=counter,
+                            count=stored[(cond, counter)]).\
+                update({ConditionCount.count: count},
+                       synchronize_session=False)
+    db_session.commit()
+    LAST_CONDCOUNT_SWEEP[(codeversion, mode)] = datetime.datetime.now()
+
+def get_random_condcount(mode):
+    """
+    Choose a random condition and counterbalance from those with the fewest
+    participants, and claim it in the condition count table.
+
+    Claims only succeed if the chosen count is unchanged since it was read,
+    so participants arriving at the same time on different server workers
+    are spread over the conditions instead of all getting the same one.
+
+    Returns a tuple: (cond, condition)
+    """
+    codeversion = CONFIG.settings.experiment_code_version
+    keys = CONFIG.settings.condition_keys
+    last_sweep = LAST_CONDCOUNT_SWEEP.get((codeversion, mode))
+    swept = last_sweep is None or \
+        datetime.datetime.now() - last_sweep > CONDCOUNT_SWEEP_INTERVAL
+    if swept:
+        sweep_condcounts(mode, keys)
+
+    slots = ConditionCount.query.filter_by(codeversion=codeversion, mode=mode)
+    for attempt in range(CONDCOUNT_CLAIM_ATTEMPTS):
+        counts = read_condcounts(slots, keys)
+        if len(counts) < len(keys) and not swept:
+            # Conditions added since the last sweep have no row to claim
+            sweep_condcounts(mode, keys)
+            swept = True
+            counts = read_condcounts(slots, keys)
+        mincount = min(counts.values())
+        minima = [hsh for hsh, count in counts.iteritems() if count == mincount]
+        chosen = choice(minima)
+        claimed = slots.filter_by(cond=chosen[0], counterbalance=chosen[1],
+                                  count=mincount).\
+            update({ConditionCount.count: ConditionCount.count + 1},
+                   synchronize_session=False)
+        db_session.commit()
+        if claimed:
+            break
+    else:
+        # Still losing races; take the last choice anyway
+        slots.filter_by(cond=chosen[0], counterbalance=chosen[1]).\
+            update({ConditionCount.count: ConditionCount.count + 1},
+                   synchronize_session=False)
+        db_session.commit()
     app.logger.info("given %(a)s chose %(b)s" % {'a': counts, 'b': chosen})
 
     return chosen
 
+def count_late_completion(unique_id):
+    """
+    Participants who finish after cutoff_time have been swept out of the
+    condition counts, so count them again. Call before changing their
+    status; the caller commits.
+    """
+    late = exists().where(and_(
+        Participant.uniqueid == unique_id,
+        Participant.codeversion == ConditionCount.codeversion,
+        Participant.mode == ConditionCount.mode,
+        Participant.cond == ConditionCount.cond,
+        Participant.counterbalance == ConditionCount.counterbalance,
+        Participant.beginhit <= get_counted_after(),
+        ~Participant.status.in_([COMPLETED, SUBMITTED, CREDITED, BONUSED])))
+    ConditionCount.query.filter(late).\
+        update({ConditionCount.count: ConditionCount.count + 1},
+               synchronize_session=False)
+
+
+# Browser checks
+# ==============
+
+BROWSER_RULES = None
+
+def get_browser_info():
+    """
+    BrowserInfo (allowed, browser, platform, language) for the user agent
+    of the current request, worked out once per request.
+    """
+    global BROWSER_RULES
+    if 'browser_info' not in g:
+        rule = CONFIG.settings.browser_exclude_rule
+        if BROWSER_RULES is None or BROWSER_RULES.rule != rule:
+            BROWSER_RULES = BrowserRules(rule)
+        g.browser_info = BROWSER_RULES.classify(
+            request.headers.get('User-Agent', ''))
+    return g.browser_info
+
 
 # Routes
 # ======
@@ -194,7 +409,18 @@ def favicon():
 @app.route('/static/js/psiturk.js')
 def psiturk_js():
     ''' psiTurk js route '''
-    return render_template_string(PSITURK_JS_CODE)
+    if 'gzip' in request.accept_encodings:
+        resp = make_response(PSITURK_JS_GZIP)
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(PSITURK_JS_ETAG + GZIP_ETAG_SUFFIX)
+    else:
+        resp = make_response(PSITURK_JS)
+        resp.set_etag(PSITURK_JS_ETAG)
+    resp.mimetype = 'application/javascript'
+    resp.vary.add('Accept-Encoding')
+    resp.cache_control.public = True
+    resp.cache_control.max_age = PSITURK_JS_MAX_AGE
+    return resp.make_conditional(request)
 
 @app.route('/check_worker_status', methods=['GET'])
 def check_worker_status():
@@ -205,26 +431,17 @@ def check_worker_status():
     else:
         worker_id = request.args['workerId']
         assignment_id = request.args['assignmentId']
-        allow_repeats = CONFIG.getboolean('HIT Configuration', 'allow_repeats')
-        if allow_repeats: # if you allow repeats focus on current worker/assignment combo
-            try:
-                part = Participant.query.\
-                    filter(Participant.workerid == worker_id).\
-                    filter(Participant.assignmentid == assignment_id).one()
-                status = part.status
-            except exc.SQLAlchemyError:
-                status = NOT_ACCEPTED
-        else: # if you disallow repeats search for highest status of anything by this worker
-            try:
-                matches = Participant.query.\
-                    filter(Participant.workerid == worker_id).all()
-                numrecs = len(matches)
-                if numrecs==0: # this should be caught by exception, but just to be safe
-                    status = NOT_ACCEPTED
-                else:
-                    status = max([record.status for record in matches])
-            except exc.SQLAlchemyError:
-                status = NOT_ACCEPTED
+        allow_repeats = CONFIG.settings.allow_repeats
+        try:
+            worker = WorkerState(worker_id, assignment_id)
+            if allow_repeats: # if you allow repeats focus on current worker/assignment combo
+                status = worker.status()
+            else: # if you disallow repeats search for highest status of anything by this worker
+                status = worker.highest_status()
+        except exc.SQLAlchemyError:
+            status = None
+        if status is None:
+            status = NOT_ACCEPTED
         resp = {"status" : status}
         return jsonify(**resp)
 
@@ -243,28 +460,7 @@ def advertisement():
         These arguments will have appropriate values and we should enter the
         person in the database and provide a link to the experiment popup.
     """
-    user_agent_string = request.user_agent.string
-    user_agent_obj = user_agents.parse(user_agent_string)
-    browser_ok = True
-    for rule in string.split(
-            CONFIG.get('HIT Configuration', 'browser_exclude_rule'), ','):
-        myrule = rule.strip()
-        if myrule in ["mobile", "tablet", "touchcapable", "pc", "bot"]:
-            if (myrule == "mobile" and user_agent_obj.is_mobile) or\
-               (myrule == "tablet" and user_agent_obj.is_tablet) or\
-               (myrule == "touchcapable" and user_agent_obj.is_touch_capable) or\
-               (myrule == "pc" and user_agent_obj.is_pc) or\
-               (myrule == "bot" and user_agent_obj.is_bot):
-                browser_ok = False
-        elif (myrule == "Safari" or myrule == "safari"):
-            if "Chrome" in user_agent_string and "Safari" in user_agent_string:
-                pass
-            elif "Safari" in user_agent_string:
-                browser_ok = False
-        elif myrule in user_agent_string:
-            browser_ok = False
-
-    if not browser_ok:
+    if not get_browser_info().allowed:
         # Handler for IE users if IE is not supported.
         raise ExperimentError('browser_type_not_allowed')
 
@@ -277,30 +473,19 @@ def advertisement():
         debug_mode = True
     else:
         debug_mode = False
-    already_in_db = False
     if 'workerId' in request.args:
         worker_id = request.args['workerId']
-        # First check if this workerId has completed the task before (v1).
-        nrecords = Participant.query.\
-            filter(Participant.assignmentid != assignment_id).\
-            filter(Participant.workerid == worker_id).\
-            count()
-
-        if nrecords > 0:  # Already completed task
-            already_in_db = True
     else:  # If worker has not accepted the hit
         worker_id = None
     try:
-        part = Participant.query.\
-            filter(Participant.hitid == hit_id).\
-            filter(Participant.assignmentid == assignment_id).\
-            filter(Participant.workerid == worker_id).\
-            one()
-        status = part.status
+        worker = WorkerState(worker_id, assignment_id)
     except exc.SQLAlchemyError:
-        status = None
+        worker = WorkerState(None, assignment_id)
+    # Check if this workerId has completed the task before (v1).
+    already_in_db = worker.other_assignments > 0
+    status = worker.status(hit_id)
 
-    allow_repeats = CONFIG.getboolean('HIT Configuration', 'allow_repeats')
+    allow_repeats = CONFIG.settings.allow_repeats
     if (status == STARTED or status == QUITEARLY) and not debug_mode:
         # Once participants have finished the instructions, we do not allow
         # them to start the task again.
@@ -310,7 +495,7 @@ def advertisement():
         # to mturk fails after we've set status to SUBMITTED, so really they
         # have not successfully submitted. This gives another chance for the
         # submit to work when not using the psiturk ad server.
-        use_psiturk_ad_server = CONFIG.getboolean('Shell Parameters', 'use_psiturk_ad_server')
+        use_psiturk_ad_server = CONFIG.settings.use_psiturk_ad_server
         if not use_psiturk_ad_server:
             # They've finished the experiment but haven't successfully submitted the HIT
             # yet.
@@ -329,11 +514,8 @@ def advertisement():
     elif status == ALLOCATED or not status or debug_mode:
         # Participant has not yet agreed to the consent. They might not
         # even have accepted the HIT.
-        with open('templates/ad.html', 'r') as temp_file:
-            ad_string = temp_file.read()
-        ad_string = insert_mode(ad_string, mode)
-        return render_template_string(
-            ad_string,
+        return render_mode_template(
+            'templates/ad.html', mode,
             hitid=hit_id,
             assignmentid=assignment_id,
             workerid=worker_id
@@ -354,24 +536,66 @@ def give_consent():
     assignment_id = request.args['assignmentId']
     worker_id = request.args['workerId']
     mode = request.args['mode']
-    with open('templates/consent.html', 'r') as temp_file:
-        consent_string = temp_file.read()
-    consent_string = insert_mode(consent_string, mode)
-    return render_template_string(
-        consent_string,
+    return render_mode_template(
+        'templates/consent.html', mode,
         hitid=hit_id,
         assignmentid=assignment_id,
         workerid=worker_id
     )
 
+# Ad ids found for HITs: hit id -> (ad id, time to look it up again)
+AD_IDS = {}
+AD_ID_TTL = datetime.timedelta(hours=1)
+# Connections to the ad server are kept open between lookups, and a slow
+# ad server fails the lookup rather than holding up the worker
+AD_SERVER = None
+AD_SERVER_TIMEOUT = (3.05, 5)
+
+def get_ad_server():
+    ''' The session used to talk to the ad server, set up on first use so
+    that servers not using it never import requests '''
+    global AD_SERVER
+    if AD_SERVER is None:
+        import requests
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=10, max_retries=1))
+        AD_SERVER = session
+    return AD_SERVER
+
 def get_ad_via_hitid(hit_id):
-    ''' Get ad via HIT id '''
-    username = CONFIG.get('psiTurk Access', 'psiturk_access_key_id')
-    password = CONFIG.get('psiTurk Access', 'psiturk_secret_access_id')
+    ''' Get ad via HIT id, from memory or the database if it has been
+    seen before '''
+    cached = AD_IDS.get(hit_id)
+    if cached is not None and cached[1] > datetime.datetime.now():
+        return cached[0]
+
+    hit_ad = HitAd.query.get(hit_id)
+    if hit_ad is not None:
+        ad_id = hit_ad.adid
+    else:
+        ad_id = lookup_ad_id(hit_id)
+        if ad_id == "error":
+            return ad_id
+        try:
+            db_session.merge(HitAd(hitid=hit_id, adid=str(ad_id)))
+            db_session.commit()
+        except exc.SQLAlchemyError:
+            # another worker saved it first
+            db_session.rollback()
+    AD_IDS[hit_id] = (ad_id, datetime.datetime.now() + AD_ID_TTL)
+    return ad_id
+
+def lookup_ad_id(hit_id):
+    ''' Ask the psiturk.org ad server for the ad of a HIT '''
+    username = CONFIG.settings.psiturk_access_key_id
+    password = CONFIG.settings.psiturk_secret_access_id
+    from requests.exceptions import RequestException
     try:
-        req = requests.get('https://api.psiturk.org/api/ad/lookup/' + hit_id,
-                           auth=(username, password))
-    except:
+        req = get_ad_server().get(
+            'https://api.psiturk.org/api/ad/lookup/' + hit_id,
+            auth=(username, password), timeout=AD_SERVER_TIMEOUT)
+    except RequestException:
         raise ExperimentError('api_server_not_reachable')
     else:
         if req.status_code == 200:
@@ -402,16 +626,12 @@ def start_exp():
 
     # Check first to see if this hitId or assignmentId exists.  If so, check to
     # see if inExp is set
-    allow_repeats = CONFIG.getboolean('HIT Configuration', 'allow_repeats')
+    allow_repeats = CONFIG.settings.allow_repeats
+    worker = WorkerState(worker_id, assignment_id)
     if allow_repeats:
-        matches = Participant.query.\
-            filter(Participant.workerid == worker_id).\
-            filter(Participant.assignmentid == assignment_id).\
-            all()
+        matches = worker.assignment_records
     else:
-        matches = Participant.query.\
-            filter(Participant.workerid == worker_id).\
-            all()
+        matches = worker.records
 
     numrecs = len(matches)
     if numrecs == 0:
@@ -420,12 +640,13 @@ def start_exp():
 
         worker_ip = "UNKNOWN" if not request.remote_addr else \
             request.remote_addr
-        browser = "UNKNOWN" if not request.user_agent.browser else \
-            request.user_agent.browser
-        platform = "UNKNOWN" if not request.user_agent.platform else \
-            request.user_agent.platform
-        language = "UNKNOWN" if not request.user_agent.language else \
-            request.user_agent.language
+        browser_info = get_browser_info()
+        browser = "UNKNOWN" if not browser_info.browser else \
+            browser_info.browser
+        platform = "UNKNOWN" if not browser_info.platform else \
+            browser_info.platform
+        language = "UNKNOWN" if not browser_info.language else \
+            browser_info.language
 
         # Set condition here and insert into database.
         participant_attributes = dict(
@@ -475,7 +696,7 @@ def start_exp():
             if other_assignment:
                 raise ExperimentError('already_did_exp_hit')
 
-    use_psiturk_ad_server = CONFIG.getboolean('Shell Parameters', 'use_psiturk_ad_server')
+    use_psiturk_ad_server = CONFIG.settings.use_psiturk_ad_server
     if use_psiturk_ad_server and (mode == 'sandbox' or mode == 'live'):
         # If everything goes ok here relatively safe to assume we can lookup
         # the ad.
@@ -498,9 +719,14 @@ def start_exp():
         counterbalance=part.counterbalance,
         adServerLoc=ad_server_location,
         mode = mode,
-        contact_address=CONFIG.get('HIT Configuration', 'contact_email_on_error')
+        contact_address=CONFIG.settings.contact_email_on_error
     )
 
+def is_debug_id(unique_id):
+    ''' Participants from `debug` may go through the task any number of
+    times, so their status changes are not checked '''
+    return unique_id[:5] == "debug"
+
 @app.route('/inexp', methods=['POST'])
 def enterexp():
     """
@@ -514,20 +740,104 @@ def enterexp():
     if not 'uniqueId' in request.form:
         raise ExperimentError('improper_inputs')
     unique_id = request.form['uniqueId']
+    flush_sync_buffer(unique_id)
 
     try:
-        user = Participant.query.\
-            filter(Participant.uniqueid == unique_id).one()
-        user.status = STARTED
-        user.beginexp = datetime.datetime.now()
-        db_session.add(user)
+        started = transition(unique_id, STARTED,
+                             force=is_debug_id(unique_id),
+                             beginexp=datetime.datetime.now())
         db_session.commit()
-        resp = {"status": "success"}
     except exc.SQLAlchemyError:
-        app.logger.error("DB error: Unique user not found.")
-        resp = {"status": "error, uniqueId not found"}
+        started = 0
+    if started:
+        resp = {"status": "success"}
+    else:
+        app.logger.error("Unique user not found, or already past starting.")
+        resp = {"status": "error, uniqueId not found or already started"}
     return jsonify(**resp)
 
+def write_buffered_data(batch):
+    """
+    Write a batch of buffered /sync saves (uniqueid -> (datastring, data))
+    to the database in one transaction. A save is skipped if the database
+    already holds more trials and events than it does, which happens when
+    another server worker wrote a newer save for the same participant. The
+    data is only replaced if it is still what was compared against, so a
+    save written by another worker in between is never overwritten
+    unchecked.
+    """
+    try:
+        users = Participant.query.options(undefer('datastring')).\
+            filter(Participant.uniqueid.in_(batch.keys())).all()
+        written = 0
+        for user in users:
+            datastring, data = batch[user.uniqueid]
+            stored, stored_hash = user.datastring, user.datahash
+            while True:
+                try:
+                    stored_data = json.loads(stored)
+                except (TypeError, ValueError):
+                    stored_data = {}
+                if data_size(stored_data) > data_size(data):
+                    app.logger.info("skipped stale buffered data for %s",
+                                    user.uniqueid)
+                    break
+                if Participant.query.\
+                        filter(Participant.uniqueid == user.uniqueid).\
+                        filter(Participant.datahash == stored_hash).\
+                        update({'datastring': datastring,
+                                'datahash': data_hash(datastring),
+                                'last_modified': datetime.datetime.now()},
+                               synchronize_session=False):
+                    if normalized_data():
+                        save_data_rows(user.uniqueid, data)
+                    written += 1
+                    break
+                # Another worker saved since the data was read; commit what
+                # is done so far, so a fresh read sees their save, and
+                # compare against it
+                db_session.commit()
+                stored, stored_hash = db_session.query(
+                    Participant.datastring, Participant.datahash).\
+                    filter(Participant.uniqueid == user.uniqueid).one()
+        db_session.commit()
+        app.logger.info("wrote buffered data for %d participants", written)
+    finally:
+        if not has_request_context():
+            db_session.remove()
+
+def flush_sync_buffer(unique_id):
+    """
+    Write any /sync save of unique_id's still buffered by this worker before
+    their status changes. Saves buffered by other workers are not reached;
+    the save made just before is written through (see sync_flush_requested()).
+    A failure is logged rather than failing the request, and the save stays
+    buffered for the next flush.
+    """
+    try:
+        SYNC_BUFFER.flush([unique_id])
+    except Exception:
+        app.logger.exception("Error writing buffered data for %s", unique_id)
+        db_session.rollback()
+
+def sync_flush_requested():
+    """
+    Whether a /sync save asks to be written to the database straight away
+    even with `sync_write_behind` on, as saveData({flush: true}) does for
+    the save a participant makes before starting, quitting or completing:
+    the request changing their status may go to another server worker,
+    which cannot reach this worker's buffer.
+    """
+    return request.headers.get('X-Sync-Flush', '').lower() in ['1', 'true']
+
+# /sync saves wait here when `sync_write_behind` is on, and are flushed to the
+# database together, or early when the participant moves on
+SYNC_BUFFER = WriteBehindBuffer(
+    write_buffered_data,
+    interval=CONFIG.getfloat('Server Parameters', 'sync_flush_interval'),
+    max_entries=CONFIG.getint('Server Parameters', 'sync_flush_size'))
+atexit.register(SYNC_BUFFER.stop)
+
 # TODD SAYS: This the only route in the whole thing that uses <id> like this
 # where everything else uses POST!  This could be confusing but is forced
 # somewhat by Backbone?  Take heed!
@@ -539,6 +849,12 @@ def load(uid=None):
     """
     app.logger.info("GET /sync route with id: %s" % uid)
 
+    pending = SYNC_BUFFER.get(uid)
+    if pending is not None:
+        datastring, data = pending
+        return sync_response(data, data_hash(datastring))
+
+    # The data itself is only loaded if the client does not have it already
     try:
         user = Participant.query.\
             filter(Participant.uniqueid == uid).\
@@ -546,6 +862,16 @@ def load(uid=None):
     except exc.SQLAlchemyError:
         app.logger.error("DB error: Unique user not found.")
 
+    etag = user.datahash
+    if etag is None:
+        # Rows saved before the datahash column existed get their hash here
+        etag = data_hash(user.datastring)
+    if etag is not None:
+        # The client may hold either encoding (see compress_response())
+        for variant in [etag, etag + GZIP_ETAG_SUFFIX]:
+            if variant in request.if_none_match:
+                return sync_response(None, variant)
+
     try:
         resp = json.loads(user.datastring)
     except:
@@ -557,8 +883,9 @@ def load(uid=None):
             "hitId": user.hitid,
             "bonus": user.bonus
         }
+        etag = None
 
-    return jsonify(**resp)
+    return sync_response(resp, etag)
 
 @app.route('/sync/<uid>', methods=['PUT'])
 def update(uid=None):
@@ -568,29 +895,172 @@ def update(uid=None):
     """
     app.logger.info("PUT /sync route with id: %s" % uid)
 
+    datastring = request_body().decode('utf-8').encode(
+        'ascii', 'xmlcharrefreplace'
+    )
     try:
-        user = Participant.query.\
-            filter(Participant.uniqueid == uid).\
-            one()
-    except exc.SQLAlchemyError:
-        app.logger.error("DB error: Unique user not found.")
+        data = json.loads(datastring)
+    except:
+        data = {}
+    etag = data_hash(datastring)
 
-    if hasattr(request, 'json'):
-        user.datastring = request.data.decode('utf-8').encode(
-            'ascii', 'xmlcharrefreplace'
-        )
+    if CONFIG.settings.sync_write_behind:
+        SYNC_BUFFER.put(uid, (datastring, data))
+        if sync_flush_requested():
+            SYNC_BUFFER.flush([uid])
+    else:
+        try:
+            user = Participant.query.\
+                filter(Participant.uniqueid == uid).\
+                one()
+        except exc.SQLAlchemyError:
+            app.logger.error("DB error: Unique user not found.")
+
+        # The stored data is replaced without being loaded; its hash says
+        # whether it is any different
+        if user.datahash == etag:
+            # Nothing changed since the last save
+            return sync_response({"status": "user data unchanged"}, etag)
+        user.datastring = datastring
         db_session.add(user)
+        if normalized_data():
+            save_data_rows(uid, data)
         db_session.commit()
 
-    try:
-        data = json.loads(user.datastring)
-    except:
-        data = {}
-
     trial = data.get("currenttrial", None)
     app.logger.info("saved data for %s (current trial: %s)", uid, trial)
     resp = {"status": "user data saved"}
-    return jsonify(**resp)
+    return sync_response(resp, etag)
+
+def sync_response(data, etag):
+    """
+    JSON response for the /sync routes, carrying the ETag of the stored
+    datastring. A data of None makes it a 304 Not Modified.
+    """
+    if data is None:
+        resp = make_response('', 304)
+    else:
+        resp = jsonify(**data)
+    if etag is not None:
+        resp.set_etag(etag)
+    return resp
+
+# Fields of the task data that only ever grow on the client; a delta sync
+# sends just the entries added since the last acknowledged offset.
+APPEND_ONLY_FIELDS = ['data', 'eventdata']
+
+def data_size(document):
+    """ Number of trials and events in a task data document. """
+    return sum(len(document.get(field, [])) for field in APPEND_ONLY_FIELDS)
+
+def check_delta(delta):
+    """
+    Raise InvalidUsage unless a delta sync payload is an object whose
+    appended fields are lists, whose questiondata is an object and whose
+    offsets are counts of those fields.
+    """
+    if not isinstance(delta, dict):
+        raise InvalidUsage('delta sync payload is not an object')
+    for field in APPEND_ONLY_FIELDS:
+        if not isinstance(delta.get(field, []), list):
+            raise InvalidUsage('delta sync %s is not a list' % field)
+    if not isinstance(delta.get('questiondata', {}), dict):
+        raise InvalidUsage('delta sync questiondata is not an object')
+    offsets = delta.get('offsets', {})
+    if not isinstance(offsets, dict) or not all(
+            isinstance(offsets.get(field, 0), (int, long)) and
+            not isinstance(offsets.get(field, 0), bool) and
+            offsets.get(field, 0) >= 0
+            for field in APPEND_ONLY_FIELDS):
+        raise InvalidUsage('delta sync offsets are not counts of the data '
+                           'and eventdata entries')
+
+def merge_delta(document, delta):
+    """
+    Merge a delta sync payload into a stored task data document. Returns
+    False (leaving the document untouched) if the client claims to have had
+    more entries acknowledged than are stored, in which case it has to fall
+    back to a full save.
+    """
+    offsets = delta.pop('offsets', {})
+    for field in APPEND_ONLY_FIELDS:
+        stored = document.get(field, [])
+        if offsets.get(field, len(stored)) > len(stored):
+            return False
+    for field in APPEND_ONLY_FIELDS:
+        stored = document.setdefault(field, [])
+        # A retried delta whose first attempt was saved but not acknowledged
+        # overlaps what is stored; drop the overlap before appending.
+        del stored[offsets.get(field, len(stored)):]
+        stored.extend(delta.pop(field, []))
+    document.setdefault('questiondata', {}).update(
+        delta.pop('questiondata', {}))
+    document.update(delta)
+    return True
+
+@app.route('/sync/<uid>', methods=['PATCH'])
+def update_delta(uid=None):
+    """
+    Append the trials, events and question fields collected since the last
+    acknowledged save to the stored experiment data. Other fields in the
+    payload replace the stored values.
+    """
+    app.logger.info("PATCH /sync route with id: %s" % uid)
+
+    write_behind = CONFIG.settings.sync_write_behind
+    pending = SYNC_BUFFER.get(uid) if write_behind else None
+    if pending is None:
+        try:
+            user = Participant.query.options(undefer('datastring')).\
+                filter(Participant.uniqueid == uid).\
+                one()
+        except exc.SQLAlchemyError:
+            raise InvalidUsage('unique id not found', status_code=404)
+        stored = user.datastring
+    else:
+        stored = pending[0]
+
+    try:
+        delta = json.loads(request_body())
+    except ValueError:
+        raise InvalidUsage('delta sync payload is not valid JSON')
+    check_delta(delta)
+
+    try:
+        document = json.loads(stored)
+    except (TypeError, ValueError):
+        document = {}
+
+    offsets = dict((field, len(document.get(field, [])))
+                   for field in APPEND_ONLY_FIELDS)
+    starts = dict((field, delta.get('offsets', offsets).get(field,
+                                                           offsets[field]))
+                  for field in APPEND_ONLY_FIELDS)
+    questions = delta.get('questiondata', {}).keys()
+    if not merge_delta(document, delta):
+        app.logger.info("delta sync for %s ahead of stored data %s", uid,
+                        offsets)
+        raise InvalidUsage('delta sync out of order, send the full data',
+                           status_code=409, payload={'offsets': offsets})
+
+    datastring = json.dumps(document)
+    if write_behind:
+        SYNC_BUFFER.put(uid, (datastring, document))
+        if sync_flush_requested():
+            SYNC_BUFFER.flush([uid])
+    else:
+        user.datastring = datastring
+        db_session.add(user)
+        if normalized_data():
+            save_data_rows(uid, document, starts, questions)
+        db_session.commit()
+
+    offsets = dict((field, len(document[field]))
+                   for field in APPEND_ONLY_FIELDS)
+    app.logger.info("appended data for %s (current trial: %s)", uid,
+                    document.get("currenttrial", None))
+    resp = {"status": "user data saved", "offsets": offsets}
+    return sync_response(resp, data_hash(datastring))
 
 @app.route('/quitter', methods=['POST'])
 def quitter():
@@ -598,6 +1068,7 @@ def quitter():
     Mark quitter as such.
     """
     unique_id = request.form['uniqueId']
+    flush_sync_buffer(unique_id)
     if unique_id[:5] == "debug":
         debug_mode = True
     else:
@@ -607,20 +1078,16 @@ def quitter():
         resp = {"status": "didn't mark as quitter since this is debugging"}
         return jsonify(**resp)
     else:
+        app.logger.info("Marking quitter %s" % unique_id)
         try:
-            unique_id = request.form['uniqueId']
-            app.logger.info("Marking quitter %s" % unique_id)
-            user = Participant.query.\
-                filter(Participant.uniqueid == unique_id).\
-                one()
-            user.status = QUITEARLY
-            db_session.add(user)
+            marked = transition(unique_id, QUITEARLY)
             db_session.commit()
         except exc.SQLAlchemyError:
+            marked = 0
+        if not marked:
             raise ExperimentError('tried_to_quit')
-        else:
-            resp = {"status": "marked as quitter"}
-            return jsonify(**resp)
+        resp = {"status": "marked as quitter"}
+        return jsonify(**resp)
 
 # Note: This route should only used when debugging
 # or when not using the psiturk adserver
@@ -633,20 +1100,21 @@ def debug_complete():
     else:
         unique_id = request.args['uniqueId']
         mode = request.args['mode']
+        flush_sync_buffer(unique_id)
         try:
-            user = Participant.query.\
-                filter(Participant.uniqueid == unique_id).one()
-            user.status = COMPLETED
-            user.endhit = datetime.datetime.now()
-            db_session.add(user)
+            count_late_completion(unique_id)
+            completed = transition(unique_id, COMPLETED,
+                                   force=is_debug_id(unique_id),
+                                   endhit=datetime.datetime.now())
             db_session.commit()
-        except:
+        except exc.SQLAlchemyError:
+            completed = 0
+        if not completed:
             raise ExperimentError('error_setting_worker_complete')
+        if (mode == 'sandbox' or mode == 'live'): # send them back to mturk.
+            return render_template('closepopup.html')
         else:
-            if (mode == 'sandbox' or mode == 'live'): # send them back to mturk.
-                return render_template('closepopup.html')
-            else:
-                return render_template('complete.html')
+            return render_template('complete.html')
 
 @app.route('/worker_complete', methods=['GET'])
 def worker_complete():
@@ -657,14 +1125,14 @@ def worker_complete():
     else:
         unique_id = request.args['uniqueId']
         app.logger.info("Completed experiment %s" % unique_id)
+        flush_sync_buffer(unique_id)
         try:
-            user = Participant.query.\
-                filter(Participant.uniqueid == unique_id).one()
-            user.status = COMPLETED
-            user.endhit = datetime.datetime.now()
-            db_session.add(user)
+            count_late_completion(unique_id)
+            completed = transition(unique_id, COMPLETED,
+                                   force=is_debug_id(unique_id),
+                                   endhit=datetime.datetime.now())
             db_session.commit()
-            status = "success"
+            status = "success" if completed else "status not changed"
         except exc.SQLAlchemyError:
             status = "database error"
         resp = {"status" : status}
@@ -680,17 +1148,75 @@ def worker_submitted():
         unique_id = request.args['uniqueId']
         app.logger.info("Submitted experiment for %s" % unique_id)
         try:
-            user = Participant.query.\
-                filter(Participant.uniqueid == unique_id).one()
-            user.status = SUBMITTED
-            db_session.add(user)
+            submitted = transition(unique_id, SUBMITTED,
+                                   force=is_debug_id(unique_id))
             db_session.commit()
-            status = "success"
+            status = "success" if submitted else "status not changed"
         except exc.SQLAlchemyError:
             status = "database error"
         resp = {"status" : status}
         return jsonify(**resp)
 
+# Data export
+# ===========
+
+EXPORT_AUTH = PsiTurkAuthorization(CONFIG)
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+# The login_username and login_pw of local_config_defaults.txt, which the
+# data is never served with
+EXAMPLE_LOGIN = ('examplename', 'examplepassword')
+
+def query_date(name):
+    ''' The date in a query parameter, or None if it is missing or empty. '''
+    return parse_date(request.args[name]) if request.args.get(name) else None
+
+@app.route('/data/<datafile>.<file_format>', methods=['GET'])
+@EXPORT_AUTH.requires_auth
+def export_data(datafile, file_format):
+    """
+    Stream trialdata, eventdata or questiondata as csv (the same as
+    download_datafiles writes) or as newline-delimited JSON, for the
+    participants chosen by the codeversion, status (repeatable), mode, since
+    and until query parameters (empty ones are ignored). Only served if
+    `data_export_routes` is on, to those with the login_username and
+    login_pw, and never while those are still the example ones.
+    """
+    if not CONFIG.settings.data_export_routes or \
+            datafile not in DATAFILES or file_format not in EXPORT_FORMATS:
+        raise InvalidUsage('no such data file', status_code=404)
+    if (EXPORT_AUTH.queryname, EXPORT_AUTH.querypw) == EXAMPLE_LOGIN:
+        app.logger.warning("Refused to export data: login_username and "
+                           "login_pw are still the example ones")
+        raise InvalidUsage('change login_username and login_pw from their '
+                           'example values to export data', status_code=403)
+    try:
+        filters = dict(
+            codeversion=request.args.get('codeversion') or None,
+            statuses=[parse_status(status)
+                      for status in request.args.getlist('status') if status],
+            mode=request.args.get('mode') or None,
+            since=query_date('since'),
+            until=query_date('until'))
+    except ValueError as error:
+        raise InvalidUsage(str(error))
+    app.logger.info("Exporting %s.%s for %s", datafile, file_format,
+                    request.authorization.username)
+
+    # Rows are read from the database as they are sent, so that big
+    # studies are never held in memory
+    rows = datafile_rows(datafile,
+                         filter_participants(Participant.query, **filters))
+    if file_format == 'csv':
+        chunks = csv_chunks(rows)
+    else:
+        chunks = ndjson_chunks(datafile, rows)
+    response = Response(stream_with_context(chunks),
+                        mimetype=EXPORT_FORMATS[file_format])
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=%s.%s' % (datafile, file_format)
+    response.cache_control.no_cache = True
+    return response
+
 # Is this a security risk?
 @app.route("/ppid")
 def ppid():
@@ -715,6 +1241,31 @@ def insert_mode(page_html, mode):
     else:
         raise ExperimentError("insert_mode_failed")
 
+# Modes whose compiled ad and consent templates are cached; anything else
+# comes from the query string and is compiled afresh each time
+CACHED_MODES = ['debug', 'sandbox', 'live']
+# (path, mode) -> (file mtime, compiled template with the mode inserted)
+MODE_TEMPLATES = {}
+
+def get_mode_template(path, mode):
+    ''' Compiled template for the page at path with mode inserted,
+    recompiled only when the file changes '''
+    mtime = os.path.getmtime(path)
+    cached = MODE_TEMPLATES.get((path, mode))
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as temp_file:
+            page_html = insert_mode(temp_file.read(), mode)
+        cached = (mtime, app.jinja_env.from_string(page_html))
+        if mode in CACHED_MODES:
+            MODE_TEMPLATES[(path, mode)] = cached
+    return cached[1]
+
+def render_mode_template(path, mode, **context):
+    ''' Render the page at path with mode inserted '''
+    app.update_template_context(context)
+    return get_mode_template(path, mode).render(context)
+
+
 
 # Generic route
 # =============
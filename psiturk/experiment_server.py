@@ -2,12 +2,11 @@
 from gunicorn.app.base import Application
 from gunicorn import util
 import multiprocessing
-from psiturk_config import PsiturkConfig
+from psiturk_config import get_config
 import os
 import hashlib
 
-config = PsiturkConfig()
-config.load_config()
+config = get_config()
 
 class ExperimentServer(Application):
     '''
@@ -65,6 +64,15 @@ class ExperimentServer(Application):
             print 'Caught ^C, experiment server has shut down.'
             print 'Press `enter` to continue.'
 
+        def worker_exit(server, worker):
+            '''
+            write any task data still waiting in this worker's
+            write-behind buffer (see `sync_write_behind`) before
+            the worker goes away
+            '''
+            from psiturk.experiment import SYNC_BUFFER
+            SYNC_BUFFER.stop()
+
         # add unique identifier of this psiturk project folder
         project_hash = hashlib.sha1(os.getcwd()).hexdigest()[:12]
         self.user_options = {
@@ -76,7 +84,8 @@ class ExperimentServer(Application):
             'errorlog': config.get("Server Parameters", "logfile"),
             'proc_name': 'psiturk_experiment_server_' + project_hash,
             'limit_request_line': '0',
-            'on_exit': on_exit
+            'on_exit': on_exit,
+            'worker_exit': worker_exit
         }
 
         if config.has_option("Server Parameters", "certfile") and config.has_option("Server Parameters", "keyfile"):
@@ -1,27 +1,98 @@
 
 import datetime
 import io, csv, json
-from sqlalchemy import Column, Integer, String, DateTime, Float, Text
+import zlib
+import hashlib
+from sqlalchemy import event, Column, Integer, BigInteger, String, DateTime, Float, \
+    Text, LargeBinary, Index, inspect
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.orm import deferred
 
-from db import Base
-from psiturk_config import PsiturkConfig
+from db import Base, db_session, engine
+from psiturk_config import get_config
 
-config = PsiturkConfig()
-config.load_config()
+config = get_config()
 
 TABLENAME = config.get('Database Parameters', 'table_name')
 CODE_VERSION = config.get('Task Parameters', 'experiment_code_version')
+DATASTRING_COMPRESSION = config.get('Database Parameters',
+                                    'datastring_compression').lower()
+if DATASTRING_COMPRESSION not in ['zlib', 'none']:
+    raise ValueError("datastring_compression must be 'zlib' or 'none', not "
+                     "'%s'" % DATASTRING_COMPRESSION)
+
+def normalized_data():
+    ''' Whether `normalized_data` is on, as of the latest settings of the
+    shared config (see PsiturkConfig.refresh_settings()), which is also what
+    the server writes by. '''
+    config = get_config()
+    if config.settings is None:
+        config.refresh_settings()
+    return config.settings.normalized_data
+
+# Status codes
+NOT_ACCEPTED = 0
+ALLOCATED = 1
+STARTED = 2
+COMPLETED = 3
+SUBMITTED = 4
+CREDITED = 5
+QUITEARLY = 6
+BONUSED = 7
+
+# The statuses a participant may move to each status from
+TRANSITIONS = {
+    STARTED: [ALLOCATED, STARTED],
+    QUITEARLY: [ALLOCATED, STARTED, QUITEARLY],
+    COMPLETED: [ALLOCATED, STARTED, QUITEARLY, COMPLETED],
+    SUBMITTED: [STARTED, COMPLETED, QUITEARLY, SUBMITTED],
+    CREDITED: [COMPLETED, SUBMITTED, CREDITED],
+    BONUSED: [COMPLETED, SUBMITTED, CREDITED, BONUSED]
+}
+
+
+
+class CompressedText(TypeDecorator):
+    """
+    Text stored zlib-compressed in a binary column. Values that are not zlib
+    streams (rows saved before compression was turned on) are returned as
+    they are.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return zlib.compress(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        try:
+            value = zlib.decompress(value)
+        except zlib.error:
+            pass
+        return value.decode('utf-8')
+
 
 class Participant(Base):
     """
     Object representation of a participant in the database.
     """
     __tablename__ = TABLENAME
+    # Counting participants per condition filters on all of these
+    __table_args__ = (
+        Index('ix_%s_counterbalance' % TABLENAME,
+              'codeversion', 'mode', 'status', 'beginhit'),
+    )
 
     uniqueid =Column(String(128), primary_key=True)
-    assignmentid =Column(String(128), nullable=False)
-    workerid = Column(String(128), nullable=False)
-    hitid = Column(String(128), nullable=False)
+    assignmentid =Column(String(128), nullable=False, index=True)
+    workerid = Column(String(128), nullable=False, index=True)
+    hitid = Column(String(128), nullable=False, index=True)
     ipaddress = Column(String(128))
     browser = Column(String(128))
     platform = Column(String(128))
@@ -33,18 +104,26 @@ class Participant(Base):
     beginexp = Column(DateTime)
     endhit = Column(DateTime)
     bonus = Column(Float, default = 0)
-    status = Column(Integer, default = 1)
+    status = Column(Integer, default = ALLOCATED, index=True)
     mode = Column(String(128))
-    if 'postgres://' in config.get('Database Parameters', 'database_url').lower():
-        datastring = Column(Text)
+    # The experiment data is only loaded when it is used; queries that will
+    # use it for many participants should ask for it up front with
+    # .options(undefer('datastring'))
+    if DATASTRING_COMPRESSION == 'zlib':
+        datastring = deferred(Column(CompressedText(4294967295)))
+    elif 'postgres://' in config.get('Database Parameters', 'database_url').lower():
+        datastring = deferred(Column(Text))
     else:
-        datastring = Column(Text(4294967295))
+        datastring = deferred(Column(Text(4294967295)))
+    datahash = Column(String(40))
+    # When the data or status last changed, for incremental exports
+    last_modified = Column(DateTime, index=True)
 
     def __init__(self, **kwargs):
         self.uniqueid = "{workerid}:{assignmentid}".format(**kwargs)
         for key in kwargs:
             setattr(self, key, kwargs[key])
-        self.status = 1
+        self.status = ALLOCATED
         self.codeversion = CODE_VERSION
         self.beginhit = datetime.datetime.now()
 
@@ -56,6 +135,12 @@ class Participant(Base):
             self.codeversion)
 
     def get_trial_data(self):
+        if normalized_data():
+            return rows_to_csv(
+                (row.uniqueid, row.current_trial, row.datetime, row.payload)
+                for row in TrialData.query.
+                filter(TrialData.uniqueid == self.uniqueid).
+                order_by(TrialData.seq))
         try:
             trialdata = json.loads(self.datastring)["data"]
         except (TypeError, ValueError):
@@ -80,6 +165,13 @@ class Participant(Base):
             return("")
 
     def get_event_data(self):
+        if normalized_data():
+            return rows_to_csv(
+                (row.uniqueid, row.eventtype, row.interval,
+                 json.loads(row.value), row.timestamp)
+                for row in EventData.query.
+                filter(EventData.uniqueid == self.uniqueid).
+                order_by(EventData.seq))
         try:
             eventdata = json.loads(self.datastring)["eventdata"]
         except (ValueError, TypeError):
@@ -100,6 +192,11 @@ class Participant(Base):
             return("")
 
     def get_question_data(self):
+        if normalized_data():
+            return rows_to_csv(
+                (row.uniqueid, row.question, json.loads(row.response))
+                for row in QuestionData.query.
+                filter(QuestionData.uniqueid == self.uniqueid))
         try:
             questiondata = json.loads(self.datastring)["questiondata"]
         except (TypeError, ValueError):
@@ -119,3 +216,288 @@ class Participant(Base):
             print("Error reading record:", self)
             return("")
 
+
+def data_hash(datastring):
+    """ Content hash of a datastring, used as its ETag. """
+    if datastring is None:
+        return None
+    if isinstance(datastring, unicode):
+        datastring = datastring.encode('utf-8')
+    return hashlib.sha1(datastring).hexdigest()
+
+@event.listens_for(Participant.datastring, 'set')
+def update_datahash(participant, value, oldvalue, initiator):
+    participant.datahash = data_hash(value)
+    participant.last_modified = datetime.datetime.now()
+
+@event.listens_for(Participant.status, 'set')
+def update_last_modified(participant, value, oldvalue, initiator):
+    participant.last_modified = datetime.datetime.now()
+
+
+def transition(uniqueid, status, force=False, **values):
+    """
+    Move a participant to status, and set any other columns given as
+    keyword arguments, in a single UPDATE. Nothing changes if their current
+    status may not move to this one (see TRANSITIONS), unless force is set.
+    Returns the number of participants changed, 0 or 1; the caller commits.
+    """
+    query = Participant.query.filter(Participant.uniqueid == uniqueid)
+    if not force:
+        query = query.filter(Participant.status.in_(TRANSITIONS[status]))
+    values['status'] = status
+    values.setdefault('last_modified', datetime.datetime.now())
+    return query.update(values, synchronize_session=False)
+
+
+class HitAd(Base):
+    """
+    The psiturk.org ad registered for a HIT, so that /exp does not have to
+    ask the ad server for it.
+    """
+    __tablename__ = TABLENAME + '_hitad'
+
+    hitid = Column(String(128), primary_key=True)
+    adid = Column(String(128), nullable=False)
+
+
+class WorkerState(object):
+    """
+    What the participant entry routes need to know about a worker's
+    records, looked up with one query on workerid that loads only the
+    columns needed (not the datastring).
+    """
+
+    def __init__(self, worker_id, assignment_id):
+        if worker_id is None:
+            self.records = []
+        else:
+            self.records = db_session.query(
+                Participant.uniqueid, Participant.assignmentid,
+                Participant.hitid, Participant.status, Participant.cond,
+                Participant.counterbalance).\
+                filter(Participant.workerid == worker_id).all()
+        self.assignment_records = [record for record in self.records
+                                   if record.assignmentid == assignment_id]
+        self.other_assignments = len(self.records) - \
+            len(self.assignment_records)
+
+    def status(self, hit_id=None):
+        ''' Status of the worker's record for this assignment (and HIT, if
+        given), or None unless there is exactly one. '''
+        matches = [record for record in self.assignment_records
+                   if hit_id is None or record.hitid == hit_id]
+        if len(matches) != 1:
+            return None
+        return matches[0].status
+
+    def highest_status(self):
+        ''' Highest status across all of the worker's records, or None if
+        there are none. '''
+        if not self.records:
+            return None
+        return max(record.status for record in self.records)
+
+
+class ConditionCount(Base):
+    """
+    Number of participants counted towards each condition and counterbalance
+    when assigning new participants; see get_random_condcount().
+    """
+    __tablename__ = TABLENAME + '_condcount'
+
+    codeversion = Column(String(128), primary_key=True)
+    mode = Column(String(128), primary_key=True)
+    cond = Column(Integer, primary_key=True, autoincrement=False)
+    counterbalance = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# Normalized copies of the task data, one row per trial, event and question,
+# kept alongside Participant.datastring when `normalized_data` is on.
+
+
+class TrialData(Base):
+    """
+    One trial recorded with psiturk.recordTrialData().
+    """
+    __tablename__ = TABLENAME + '_trialdata'
+
+    id = Column(Integer, primary_key=True)
+    uniqueid = Column(String(128), nullable=False, index=True)
+    seq = Column(Integer, nullable=False)
+    current_trial = Column(Integer)
+    datetime = Column(BigInteger)
+    payload = Column(Text)
+
+
+class EventData(Base):
+    """
+    One browser event (focus, resize, ...) logged by psiturk.js.
+    """
+    __tablename__ = TABLENAME + '_eventdata'
+
+    id = Column(Integer, primary_key=True)
+    uniqueid = Column(String(128), nullable=False, index=True)
+    seq = Column(Integer, nullable=False)
+    eventtype = Column(String(128))
+    interval = Column(BigInteger)
+    value = Column(Text)
+    timestamp = Column(BigInteger)
+
+
+class QuestionData(Base):
+    """
+    One field recorded with psiturk.recordUnstructuredData().
+    """
+    __tablename__ = TABLENAME + '_questiondata'
+
+    id = Column(Integer, primary_key=True)
+    uniqueid = Column(String(128), nullable=False, index=True)
+    question = Column(String(255))
+    response = Column(Text)
+
+
+def rows_to_csv(rows):
+    with io.BytesIO() as outstring:
+        csvwriter = csv.writer(outstring)
+        for row in rows:
+            csvwriter.writerow(row)
+        return outstring.getvalue()
+
+def save_data_rows(uniqueid, document, offsets=None, questions=None):
+    """
+    Bulk insert the trials and events of a task data document from the given
+    offsets on, and the given question fields (all of them if None), into
+    the normalized tables. Rows already stored past an offset are replaced.
+    Without offsets, everything not yet stored is inserted. Does not commit.
+    """
+    if offsets is None:
+        offsets = {
+            'data': TrialData.query.
+                    filter(TrialData.uniqueid == uniqueid).count(),
+            'eventdata': EventData.query.
+                         filter(EventData.uniqueid == uniqueid).count()
+        }
+
+    for field, table, to_row in [('data', TrialData, trial_row),
+                                 ('eventdata', EventData, event_row)]:
+        entries = document.get(field, [])
+        start = min(offsets.get(field, 0), len(entries))
+        db_session.query(table).\
+            filter(table.uniqueid == uniqueid).\
+            filter(table.seq >= start).\
+            delete(synchronize_session=False)
+        rows = [to_row(uniqueid, start + i, entry)
+                for i, entry in enumerate(entries[start:])]
+        if rows:
+            db_session.execute(table.__table__.insert(), rows)
+
+    questiondata = document.get('questiondata', {})
+    if questions is None:
+        questions = questiondata.keys()
+        stale = QuestionData.query.filter(QuestionData.uniqueid == uniqueid)
+    else:
+        questions = [q for q in questions if q in questiondata]
+        if not questions:
+            return
+        stale = QuestionData.query.\
+            filter(QuestionData.uniqueid == uniqueid).\
+            filter(QuestionData.question.in_(questions))
+    stale.delete(synchronize_session=False)
+    rows = [question_row(uniqueid, question, questiondata[question])
+            for question in questions]
+    if rows:
+        db_session.execute(QuestionData.__table__.insert(), rows)
+
+def trial_row(uniqueid, seq, trial):
+    return dict(uniqueid=uniqueid, seq=seq,
+                current_trial=trial.get("current_trial"),
+                datetime=trial.get("dateTime"),
+                payload=json.dumps(trial.get("trialdata")))
+
+def event_row(uniqueid, seq, event):
+    return dict(uniqueid=uniqueid, seq=seq,
+                eventtype=event.get("eventtype"),
+                interval=event.get("interval"),
+                value=json.dumps(event.get("value")),
+                timestamp=event.get("timestamp"))
+
+def question_row(uniqueid, question, response):
+    return dict(uniqueid=uniqueid, question=question,
+                response=json.dumps(response))
+
+def backfill_data_tables(batch_size=100):
+    """
+    Rebuild the normalized trial, event and question rows of every
+    participant from their stored datastring. Returns the number of
+    participants processed.
+    """
+    uniqueids = [uniqueid for (uniqueid,) in
+                 db_session.query(Participant.uniqueid)]
+    for start in range(0, len(uniqueids), batch_size):
+        batch = uniqueids[start:start + batch_size]
+        for uniqueid, datastring in db_session.query(
+                Participant.uniqueid, Participant.datastring).\
+                filter(Participant.uniqueid.in_(batch)):
+            try:
+                document = json.loads(datastring)
+            except (TypeError, ValueError):
+                document = {}
+            save_data_rows(uniqueid, document,
+                           offsets={'data': 0, 'eventdata': 0})
+        db_session.commit()
+    return len(uniqueids)
+
+def add_indexes():
+    """
+    Create the indexes declared on the participant table that an existing
+    table does not have yet; create_all() only makes them for new tables.
+    Returns the names of the indexes created.
+    """
+    existing = inspect(engine).get_indexes(TABLENAME)
+    existing_names = set(index['name'] for index in existing)
+    existing_columns = [list(index['column_names']) for index in existing]
+    created = []
+    for index in sorted(Participant.__table__.indexes,
+                        key=lambda index: index.name):
+        columns = [column.name for column in index.columns]
+        if index.name in existing_names or columns in existing_columns:
+            continue
+        index.create(bind=engine)
+        created.append(index.name)
+    return created
+
+def compress_datastrings(batch_size=100):
+    """
+    Convert the datastring column of an existing table to a binary column
+    and rewrite every stored datastring compressed. Only needed for tables
+    created before `datastring_compression` was set to zlib. Returns the
+    number of participants rewritten.
+    """
+    table = Participant.__table__
+    column_types = dict((column['name'], column['type']) for column in
+                        inspect(engine).get_columns(TABLENAME))
+    if not isinstance(column_types['datastring'], LargeBinary):
+        if engine.dialect.name == 'mysql':
+            engine.execute('ALTER TABLE %s MODIFY datastring LONGBLOB'
+                           % TABLENAME)
+        elif engine.dialect.name == 'postgresql':
+            engine.execute('ALTER TABLE %s ALTER COLUMN datastring TYPE '
+                           "bytea USING convert_to(datastring, 'UTF8')"
+                           % TABLENAME)
+        # sqlite stores the compressed bytes in the old column just fine
+
+    uniqueids = [uniqueid for (uniqueid,) in
+                 db_session.query(Participant.uniqueid)]
+    for start in range(0, len(uniqueids), batch_size):
+        batch = uniqueids[start:start + batch_size]
+        for uniqueid, datastring in db_session.query(
+                Participant.uniqueid, Participant.datastring).\
+                filter(Participant.uniqueid.in_(batch)):
+            db_session.execute(
+                table.update().
+                where(table.c.uniqueid == uniqueid).
+                values(datastring=datastring))
+        db_session.commit()
+    return len(uniqueids)
@@ -1,7 +1,21 @@
 import os
+import json
+from collections import namedtuple
 from distutils import file_util
 from ConfigParser import SafeConfigParser
 
+# Parsed values of the options the experiment server reads while serving
+# participants; see PsiturkConfig.refresh_settings()
+Settings = namedtuple('Settings', [
+    'allow_repeats', 'browser_exclude_rule', 'contact_email_on_error',
+    'use_psiturk_ad_server', 'psiturk_access_key_id',
+    'psiturk_secret_access_id', 'cutoff_time', 'experiment_code_version',
+    'condition_keys', 'normalized_data', 'sync_write_behind',
+    'data_export_routes'])
+
+# The config shared by the modules of one process; see get_config()
+SHARED_CONFIG = None
+
 
 class PsiturkConfig(SafeConfigParser):
 
@@ -22,6 +36,8 @@ class PsiturkConfig(SafeConfigParser):
         self.parent.__init__(self, **kwargs)
         self.localFile = localConfig
         self.globalFile = os.path.expanduser(globalConfig)
+        self.settings = None
+        self.conditions_file = None
 
     def load_config(self):
         defaults_folder = os.path.join(
@@ -71,3 +87,72 @@ class PsiturkConfig(SafeConfigParser):
             self.set('Server Parameters', 'port', os.environ['PORT'])
             self.set('Database Parameters', 'database_url',
                      os.environ['DATABASE_URL'])
+
+    def refresh_settings(self, conditions_file=None):
+        '''
+        Parse and check the options in Settings, plus the conditions file
+        if there is one (otherwise num_conds and num_counters give the
+        conditions), into a read-only snapshot kept in self.settings. Raises
+        ValueError for a missing or badly typed option. Call again after
+        changing the config to see the change.
+        '''
+        if conditions_file is not None:
+            self.conditions_file = conditions_file
+        if self.conditions_file and os.path.exists(self.conditions_file):
+            with open(self.conditions_file) as conditions:
+                numconds = len(json.load(conditions).keys())
+            numcounts = 1
+        else:
+            numconds = self.getint('Task Parameters', 'num_conds')
+            numcounts = self.getint('Task Parameters', 'num_counters')
+        cutoff_time = self.getint('Server Parameters', 'cutoff_time')
+        if numconds < 1 or numcounts < 1 or cutoff_time < 0:
+            raise ValueError("num_conds and num_counters must be at least 1, "
+                             "and cutoff_time at least 0")
+        self.settings = Settings(
+            allow_repeats=self.getboolean('HIT Configuration',
+                                          'allow_repeats'),
+            browser_exclude_rule=self.get('HIT Configuration',
+                                          'browser_exclude_rule'),
+            contact_email_on_error=self.get('HIT Configuration',
+                                            'contact_email_on_error'),
+            use_psiturk_ad_server=self.getboolean('Shell Parameters',
+                                                  'use_psiturk_ad_server'),
+            psiturk_access_key_id=self.get('psiTurk Access',
+                                           'psiturk_access_key_id'),
+            psiturk_secret_access_id=self.get('psiTurk Access',
+                                              'psiturk_secret_access_id'),
+            cutoff_time=cutoff_time,
+            experiment_code_version=self.get('Task Parameters',
+                                             'experiment_code_version'),
+            condition_keys=tuple((cond, counter)
+                                 for cond in range(numconds)
+                                 for counter in range(numcounts)),
+            normalized_data=self.getboolean('Database Parameters',
+                                            'normalized_data'),
+            sync_write_behind=self.getboolean('Server Parameters',
+                                              'sync_write_behind'),
+            data_export_routes=self.getboolean('Server Parameters',
+                                               'data_export_routes'))
+        return self.settings
+
+
+def get_config():
+    '''
+    The PsiturkConfig of the project in the current directory, loaded the
+    first time it is asked for and shared after that, so that the modules
+    imported by the server and the shell read the config files once.
+    '''
+    global SHARED_CONFIG
+    if SHARED_CONFIG is None:
+        config = PsiturkConfig()
+        config.load_config()
+        SHARED_CONFIG = config
+    return SHARED_CONFIG
+
+
+def reset_config():
+    ''' Forget the shared config; the next get_config() reads the files
+    again. '''
+    global SHARED_CONFIG
+    SHARED_CONFIG = None
@@ -19,9 +19,50 @@ _.extend(Backbone.Notifications, Backbone.Events);
 /*******
  * API *
  ******/
-var PsiTurk = function(uniqueId, adServerLoc, mode) {
+var PsiTurk = function(uniqueId, adServerLoc, mode, options) {
 	mode = mode || "live";  // defaults to live mode in case user doesn't pass this
+	options = _.extend({
+		deltaSync: false,  // only send data added since the last save
+		compressSync: false  // gzip saves, in browsers that support it
+	}, options);
 	var self = this;
+
+	// gzip a string with the browser's CompressionStream, then pass the
+	// compressed bytes to callback (or null if compression is unavailable)
+	var gzip = function(text, callback) {
+		if (!options.compressSync || typeof CompressionStream === "undefined") {
+			callback(null);
+			return;
+		}
+		var stream = new Blob([text]).stream().pipeThrough(new CompressionStream("gzip"));
+		new Response(stream).arrayBuffer().then(callback, function() { callback(null); });
+	};
+
+	// jQuery ajax settings sending body as JSON, compressed if possible.
+	// settings.flush asks the server to write the save to the database
+	// right away, even if it buffers saves (see sync_write_behind). Such
+	// saves are sent uncompressed and before sendJSON returns, since the
+	// page may be unloading or about to change the participant's status;
+	// only the saves made along the way are compressed.
+	var sendJSON = function(body, settings, callback) {
+		var send = function(compressed) {
+			settings = _.extend({contentType: "application/json", data: body}, settings);
+			if (settings.flush) {
+				settings.headers = _.extend({"X-Sync-Flush": "true"}, settings.headers);
+			}
+			if (compressed) {
+				settings.data = compressed;
+				settings.processData = false;
+				settings.headers = _.extend({"Content-Encoding": "gzip"}, settings.headers);
+			}
+			callback(settings);
+		};
+		if (settings.flush) {
+			send(null);
+		} else {
+			gzip(body, send);
+		}
+	};
 	
 	/****************
 	 * TASK DATA    *
@@ -48,6 +89,11 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
 		},
 		
 		initialize: function() {
+			// Number of trials and events the server has acknowledged, and
+			// the question fields changed since the last save.
+			this.acked = {data: 0, eventdata: 0};
+			this.changedQuestions = {};
+
 			this.set({ useragent: navigator.userAgent });
 			this.set({ mode: this.mode });
 			this.addEvent('initialized', null);
@@ -70,6 +116,71 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
 			var qd = this.get("questiondata");
 			qd[field] = response;
 			this.set("questiondata", qd);
+			this.changedQuestions[field] = true;
+		},
+
+		pendingCounts: function() {
+			return {data: this.get('data').length, eventdata: this.get('eventdata').length};
+		},
+
+		markSynced: function(counts) {
+			this.acked = counts || this.pendingCounts();
+		},
+
+		// Full save: PUT the whole task data
+		save: function(attrs, options) {
+			var self = this,
+			    sent = this.pendingCounts(),
+			    changed = this.changedQuestions;
+			options = _.extend({}, options);
+			var success = options.success, error = options.error;
+			this.changedQuestions = {};
+			options.success = function(model, resp, opts) {
+				self.markSynced(sent);
+				if (success) success(model, resp, opts);
+			};
+			options.error = function(model, xhr, opts) {
+				_.extend(self.changedQuestions, changed);
+				if (error) error(model, xhr, opts);
+			};
+			if (attrs) this.set(attrs);
+			sendJSON(JSON.stringify(this.toJSON()), options, function(settings) {
+				Backbone.Model.prototype.save.call(self, undefined, settings);
+			});
+		},
+
+		// Delta save: PATCH only the trials, events and question fields
+		// added since the last acknowledged save. Falls back to a full
+		// save if the server's copy does not match what we think it has.
+		saveDelta: function(options) {
+			var self = this,
+			    sent = this.pendingCounts(),
+			    changed = this.changedQuestions,
+			    delta = _.omit(this.toJSON(), 'data', 'eventdata', 'questiondata');
+			options = options || {};
+			delta.offsets = _.clone(this.acked);
+			delta.data = this.get('data').slice(this.acked.data);
+			delta.eventdata = this.get('eventdata').slice(this.acked.eventdata);
+			delta.questiondata = _.pick(this.get('questiondata'), _.keys(changed));
+			this.changedQuestions = {};
+			sendJSON(JSON.stringify(delta), {
+				type: "PATCH",
+				flush: options.flush,
+				success: function(resp) {
+					self.markSynced(sent);
+					if (options.success) options.success(self, resp, options);
+				},
+				error: function(xhr) {
+					_.extend(self.changedQuestions, changed);
+					if (xhr.status == 409) {
+						self.save(undefined, options);
+					} else if (options.error) {
+						options.error(self, xhr, options);
+					}
+				}
+			}, function(settings) {
+				$.ajax(_.result(self, 'url'), settings);
+			});
 		},
 		
 		getTrialData: function() {
@@ -261,11 +372,15 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
 	
 	// Save data to server
 	self.saveData = function(callbacks) {
-		taskdata.save(undefined, callbacks);
+		if (options.deltaSync) {
+			taskdata.saveDelta(callbacks);
+		} else {
+			taskdata.save(undefined, callbacks);
+		}
 	};
 
 	self.startTask = function () {
-		self.saveData();
+		self.saveData({flush: true});
 		
 		$.ajax("inexp", {
 				type: "POST",
@@ -275,7 +390,7 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
 		if (self.taskdata.mode != 'debug') {  // don't block people from reloading in debug mode
 			// Provide opt-out 
 			$(window).on("beforeunload", function(){
-				self.saveData();
+				self.saveData({flush: true});
 				
 				$.ajax("quitter", {
 						type: "POST",
@@ -323,7 +438,10 @@ var PsiTurk = function(uniqueId, adServerLoc, mode) {
 	/* initialized local variables */
 
 	var taskdata = new TaskData();
-	taskdata.fetch({async: false});
+	taskdata.fetch({async: false, success: function(model, resp) {
+		// only what the server sent back counts as acknowledged
+		model.markSynced({data: (resp.data || []).length, eventdata: (resp.eventdata || []).length});
+	}});
 	
 	/*  DATA: */
 	self.pages = {};
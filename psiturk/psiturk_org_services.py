@@ -6,13 +6,11 @@ import urllib2
 import json
 import requests
 from psiturk.version import version_number
-import git
 import subprocess
 import signal
 import struct
 from sys import platform as _platform
-from psiturk.psiturk_config import PsiturkConfig
-import psutil
+from psiturk.psiturk_config import get_config
 
 
 class PsiturkOrgServices(object):
@@ -202,6 +200,7 @@ class ExperimentExchangeServices(object):
                 print "*"*20
                 return
             if "clone_url" in gitr:
+                import git
                 git.Git().clone(gitr["clone_url"])
                 print "="*20
                 print "Downloading..."
@@ -229,8 +228,7 @@ class TunnelServices(object):
 
     def __init__(self, config=None):
         if not config:
-            config = PsiturkConfig()
-            config.load_config()
+            config = get_config()
         self.access_key = config.get('psiTurk Access', 'psiturk_access_key_id')
         self.secret_key = config.get('psiTurk Access', 'psiturk_secret_access_id')
         self.local_port = config.getint('Server Parameters', 'port')
@@ -294,6 +292,7 @@ class TunnelServices(object):
 
     def close(self):
         ''' Close tunnel '''
+        import psutil
         parent_pid = psutil.Process(self.tunnel.pid)
         child_pid = parent_pid.get_children(recursive=True)
         for pid in child_pid:
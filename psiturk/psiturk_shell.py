@@ -28,11 +28,14 @@ import webbrowser
 import sqlalchemy as sa
 
 from amt_services_wrapper import MTurkServicesWrapper
-from psiturk_org_services import PsiturkOrgServices, TunnelServices
 from version import version_number
-from psiturk_config import PsiturkConfig
+from psiturk_config import get_config
 import experiment_server_controller as control
-from models import Participant
+from models import backfill_data_tables, compress_datastrings, add_indexes, \
+    DATASTRING_COMPRESSION
+from static_assets import build_static, clean_static, MANIFEST_FILE
+from data_export import export_datafiles, parse_status, parse_date, \
+    columnar_format, export_incremental, merge_incremental, COLUMNAR_FILES
 from utils import *
 
 def docopt_cmd(func):
@@ -588,17 +591,120 @@ class PsiturkShell(Cmd, object):
         if self.server.is_server_running() == 'yes':
             self.server_restart()
 
-    def do_download_datafiles(self, _):
-        ''' Download datafiles. '''
-        contents = {"trialdata": lambda p: p.get_trial_data(), "eventdata": \
-                    lambda p: p.get_event_data(), "questiondata": lambda p: \
-                    p.get_question_data()}
-        query = Participant.query.all()
-        for k in contents:
-            ret = "".join([contents[k](p) for p in query])
-            temp_file = open(k + '.csv', 'w')
-            temp_file.write(ret)
-            temp_file.close()
+    def db_backfill_data_tables(self):
+        ''' Fill the trial, event and question tables from the datastrings. '''
+        print "Backfilling trial, event and question tables..."
+        count = backfill_data_tables()
+        print "Done, copied the data of %d participants." % count
+
+    def db_add_indexes(self):
+        ''' Add the participant table indexes missing from the database. '''
+        print "Adding indexes to the participant table..."
+        created = add_indexes()
+        if created:
+            print "Done, created: %s" % ', '.join(created)
+        else:
+            print "Done, all indexes were already there."
+
+    def db_compress_datastrings(self):
+        ''' Compress the datastrings already in the database. '''
+        # The same setting, read the same way, as the server compresses by
+        if DATASTRING_COMPRESSION != 'zlib':
+            print("*** Set datastring_compression = zlib in config.txt "
+                  "first.")
+            return
+        print "Compressing participant data..."
+        count = compress_datastrings()
+        print "Done, compressed the data of %d participants." % count
+
+    @docopt_cmd
+    def do_download_datafiles(self, arg):
+        """
+        Usage:
+          download_datafiles [--codeversion=<version>] [--status=<status>...]
+                             [--mode=<mode>] [--since=<date>] [--until=<date>]
+                             [--jobs=<n>]
+                             [--columnar | --incremental [--merge]]
+
+        Options:
+          --codeversion=<version>  Only participants who ran this version.
+          --status=<status>        Only participants with this status (e.g.
+                                   completed, submitted, credited, bonused).
+          --mode=<mode>            Only participants from this mode (live,
+                                   sandbox or debug).
+          --since=<date>           Only participants who began on or after
+                                   this date (YYYY-MM-DD).
+          --until=<date>           Only participants who began before this
+                                   date (YYYY-MM-DD).
+          --jobs=<n>               Export with this many processes, for large
+                                   studies on machines with several cores
+                                   [default: 1].
+          --columnar               Write the trial data to trialdata.parquet
+                                   (or, without pyarrow, a trialdata folder of
+                                   .npy files), one typed column per trial
+                                   data field, instead of trialdata.csv.
+          --incremental            Only read the participants whose data or
+                                   status changed since the last incremental
+                                   download into this folder, and add their
+                                   rows to the datafiles folder.
+          --merge                  Then put the rows in the datafiles folder
+                                   together into the three data files.
+        """
+        try:
+            filters = dict(
+                codeversion=arg['--codeversion'],
+                statuses=[parse_status(status)
+                          for status in arg['--status']],
+                mode=arg['--mode'],
+                since=arg['--since'] and parse_date(arg['--since']),
+                until=arg['--until'] and parse_date(arg['--until']))
+            jobs = int(arg['--jobs'])
+            if jobs < 1:
+                raise ValueError('--jobs must be at least 1')
+        except ValueError as error:
+            print '*** %s' % error
+            return
+        if arg['--incremental']:
+            if jobs > 1:
+                print '*** --incremental exports use one process'
+                return
+            changed, count = export_incremental(**filters)
+            print "Read %d changed participants; wrote the data of %d of " \
+                "them to the datafiles folder." % (changed, count)
+            if arg['--merge']:
+                count = merge_incremental()
+                print "Wrote the data of %d participants to trialdata.csv, " \
+                    "eventdata.csv and questiondata.csv." % count
+            return
+        if arg['--columnar']:
+            try:
+                trialdata = COLUMNAR_FILES[columnar_format()]
+            except ImportError as error:
+                print '*** %s' % error
+                return
+        else:
+            trialdata = 'trialdata.csv'
+        count = export_datafiles(jobs=jobs, columnar=arg['--columnar'],
+                                 **filters)
+        print "Wrote the data of %d participants to %s, eventdata.csv and " \
+            "questiondata.csv." % (count, trialdata)
+
+    @docopt_cmd
+    def do_build_static(self, arg):
+        """
+        Usage:
+          build_static
+          build_static clean
+        """
+        if arg['clean']:
+            clean_static()
+            print "Removed the fingerprinted copies of the static files."
+            return
+        manifest = build_static()
+        print "Fingerprinted %d static files, listed in %s." % (
+            len(manifest), MANIFEST_FILE)
+        if self.server.is_server_running() == 'yes':
+            print "Restart the server (`server restart`) to serve them."
 
     @docopt_cmd
     def do_open(self, arg):
@@ -723,23 +829,33 @@ class PsiturkNetworkShell(PsiturkShell):
     ''' Extends PsiturkShell class to include online psiTurk.org features '''
 
     _cached_web_services = None
+    _cached_tunnel = None
 
     @property
     def web_services(self):
         if not self._cached_web_services:
+            from psiturk_org_services import PsiturkOrgServices
             self._cached_web_services = PsiturkOrgServices(
                 self.config.get('psiTurk Access', 'psiturk_access_key_id'),
                 self.config.get('psiTurk Access', 'psiturk_secret_access_id'))
             self.amt_services_wrapper.set_web_services(self._cached_web_services)
         return self._cached_web_services
 
+    @property
+    def tunnel(self):
+        # Imported here so that the psiturk.org services (and requests) are
+        # only loaded once a tunnel is used
+        if not self._cached_tunnel:
+            from psiturk_org_services import TunnelServices
+            self._cached_tunnel = TunnelServices(self.config)
+        return self._cached_tunnel
+
     def __init__(self, config, server, sandbox, quiet=False):
         self.config = config
         self.quiet = quiet
         self.amt_services_wrapper = MTurkServicesWrapper(config=config, sandbox=sandbox)
 
         self.sandbox = sandbox
-        self.tunnel = TunnelServices()
 
         self.sandbox_hits = 0
         self.live_hits = 0
@@ -786,7 +902,7 @@ class PsiturkNetworkShell(PsiturkShell):
 
     def clean_up(self):
         ''' Clean up child and orphaned processes. '''
-        if self.tunnel.is_open:
+        if self._cached_tunnel and self.tunnel.is_open:
             print 'Closing tunnel...'
             self.tunnel.close()
             print 'Done.'
@@ -823,7 +939,7 @@ class PsiturkNetworkShell(PsiturkShell):
             prompt += ' mode:' + colorize('sdbx', 'bold')
         else:
             prompt += ' mode:' + colorize('live', 'bold')
-        if self.tunnel.is_open:
+        if self._cached_tunnel and self.tunnel.is_open:
             prompt += ' tunnel:' + colorize('✓', 'green')
         if self.sandbox:
             prompt += ' #HITs:' + str(self.sandbox_hits)
@@ -884,6 +1000,9 @@ class PsiturkNetworkShell(PsiturkShell):
           db aws_create_instance [<instance_id> <size> <username> <password>
                                   <dbname>]
           db aws_delete_instance [<instance_id>]
+          db backfill_data_tables
+          db compress_datastrings
+          db add_indexes
           db help
         """
         if arg['get_config']:
@@ -906,13 +1025,20 @@ class PsiturkNetworkShell(PsiturkShell):
                                            arg['<password>'], arg['<dbname>'])
         elif arg['aws_delete_instance']:
             self.db_aws_delete_instance(arg['<instance_id>'])
+        elif arg['backfill_data_tables']:
+            self.db_backfill_data_tables()
+        elif arg['compress_datastrings']:
+            self.db_compress_datastrings()
+        elif arg['add_indexes']:
+            self.db_add_indexes()
         else:
             self.help_db()
 
     db_commands = ('get_config', 'use_local_file', 'use_aws_instance',
                    'aws_list_regions', 'aws_get_region', 'aws_set_region',
                    'aws_list_instances', 'aws_create_instance',
-                   'aws_delete_instance', 'help')
+                   'aws_delete_instance', 'backfill_data_tables',
+                   'compress_datastrings', 'add_indexes', 'help')
 
     def complete_db(self, text, line, begidx, endidx):
         ''' Tab-complete db command '''
@@ -1171,7 +1297,7 @@ class PsiturkNetworkShell(PsiturkShell):
 
     def tunnel_status(self):
         ''' Get tunnel status '''
-        if self.tunnel.is_open:
+        if self._cached_tunnel and self.tunnel.is_open:
             print "For tunnel status, navigate to http://127.0.0.1:4040"
             print "Hint: In OSX, you can open a terminal link using cmd + click"
         else:
@@ -1207,8 +1333,7 @@ def run(cabinmode=False, script=None, execute=None, quiet=False):
         ]), 'red', False)
     sys.argv = [sys.argv[0]] # Drop arguments which were already processed in command_line.py
     #opt = docopt(__doc__, sys.argv[1:])
-    config = PsiturkConfig()
-    config.load_config()
+    config = get_config()
     server = control.ExperimentServerController(config)
     if cabinmode:
         shell = PsiturkShell(config, server)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" This module times the imports done while psiTurk starts up, for
+`psiturk --profile-startup` and `psiturk-server --profile-startup`. """
+
+import sys
+import timeit
+import __builtin__
+
+
+class ImportTimer(object):
+    '''
+    While in use (as a context manager), time every module imported, both
+    cumulatively (with the modules it imports) and on its own.
+    '''
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+        self.original_import = None
+
+    def __enter__(self):
+        self.original_import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self.original_import
+        return False
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        ''' __import__, noting the time taken if it loads anything new. '''
+        # "from . import x" has no module name of its own
+        label = name or '.' + ','.join(fromlist or [])
+        nested = label in [entry[0] for entry in self.stack]
+        loaded = len(sys.modules)
+        self.stack.append([label, 0.0])
+        start = timeit.default_timer()
+        try:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+        finally:
+            elapsed = timeit.default_timer() - start
+            children = self.stack.pop()[1]
+            if self.stack:
+                self.stack[-1][1] += elapsed
+            if len(sys.modules) > loaded:
+                cumulative, own = self.times.get(label, (0.0, 0.0))
+                # time spent inside an import of the same name is already
+                # counted by the outer one
+                if not nested:
+                    cumulative += elapsed
+                self.times[label] = (cumulative, own + elapsed - children)
+
+    def report(self, top=20):
+        ''' Lines listing the `top` slowest imports, slowest first. '''
+        lines = ['%10s %10s  %s' % ('total (ms)', 'self (ms)', 'module')]
+        slowest = sorted(self.times.items(), key=lambda item: item[1][0],
+                         reverse=True)
+        for name, (cumulative, own) in slowest[:top]:
+            lines.append('%10.1f %10.1f  %s' % (cumulative * 1000,
+                                                own * 1000, name))
+        return lines
+
+
+def profile_startup(modules, top=20):
+    ''' Import `modules` as startup would, then print the slowest imports and
+    the total time taken. '''
+    timer = ImportTimer()
+    start = timeit.default_timer()
+    with timer:
+        for module in modules:
+            __import__(module)
+    total = timeit.default_timer() - start
+    print '\n'.join(timer.report(top))
+    print 'Startup imports took %.1f ms in all.' % (total * 1000)
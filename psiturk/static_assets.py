@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+""" This module builds content-hashed copies of a project's static files,
+which the experiment server can then let browsers cache for good. """
+
+import os
+import json
+import gzip
+import shutil
+import hashlib
+
+MANIFEST_FILE = 'static_manifest.json'
+
+# Files worth serving gzipped; images other than svg, and woff fonts, are
+# already compressed
+COMPRESSIBLE = ['.css', '.js', '.html', '.htm', '.json', '.svg', '.txt',
+                '.xml', '.map', '.csv', '.ttf', '.eot', '.otf']
+
+
+def load_manifest(manifest_path=MANIFEST_FILE):
+    ''' Return the {file: fingerprinted file} map of the last build, or an
+    empty one if there has not been one. '''
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def fingerprint(filename, digest):
+    ''' css/style.css -> css/style.<digest>.css '''
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def file_digest(path):
+    ''' Hash of a file's contents, as used in its fingerprinted name. '''
+    with open(path, 'rb') as static_file:
+        return hashlib.md5(static_file.read()).hexdigest()[:12]
+
+
+def is_current(static_dir, filename, built, checked):
+    '''
+    Whether the file static_dir/filename still has the contents its
+    fingerprinted copy, built, was made from. The file is only hashed again
+    when its modification time or size changes; `checked` keeps the
+    answers from one call to the next.
+    '''
+    path = os.path.join(static_dir, filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    key = (stat.st_mtime, stat.st_size)
+    if filename not in checked or checked[filename][0] != key:
+        checked[filename] = (key,
+                             fingerprint(filename, file_digest(path)) == built)
+    return checked[filename][1]
+
+
+def clean_static(static_dir='static', manifest_path=MANIFEST_FILE):
+    ''' Remove the files written by build_static() and its manifest. '''
+    for built in load_manifest(manifest_path).values():
+        for path in [built, built + '.gz']:
+            path = os.path.join(static_dir, path)
+            if os.path.exists(path):
+                os.remove(path)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def build_static(static_dir='static', manifest_path=MANIFEST_FILE):
+    '''
+    Copy every file under static_dir to a name containing a hash of its
+    contents, next to a gzipped copy for text files, and write the
+    manifest mapping the original names to the new ones. Files from
+    earlier builds are replaced. Returns the manifest.
+
+    The hash in each new name is also what is_current() checks the
+    original against, so a file edited after the build is not mistaken for
+    its old copy.
+    '''
+    clean_static(static_dir, manifest_path)
+    manifest = {}
+    for dirpath, _, filenames in os.walk(static_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            filename = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            built = fingerprint(filename, file_digest(path))
+            built_path = os.path.join(static_dir, built)
+            shutil.copyfile(path, built_path)
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                with open(path, 'rb') as static_file, \
+                        gzip.open(built_path + '.gz', 'wb', 9) as gz_file:
+                    shutil.copyfileobj(static_file, gz_file)
+            manifest[filename] = built
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+""" This module provides a write-behind buffer for coalescing frequent
+saves of the same record into fewer database writes. """
+
+import threading
+import logging
+
+
+class WriteBehindBuffer(object):
+    """
+    Keeps only the latest value put for each key and hands the waiting
+    values to `writer` (a function taking a dict of key -> value) in one
+    batch every `interval` seconds, or as soon as `max_entries` keys are
+    waiting, whichever comes first.
+    """
+
+    def __init__(self, writer, interval=5, max_entries=100):
+        self.writer = writer
+        self.interval = interval
+        self.max_entries = max_entries
+        self.pending = {}
+        # Keys whose values are being written right now, and a condition
+        # notified whenever such a write finishes
+        self.writing = set()
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def put(self, key, value):
+        ''' Queue the latest value for key, replacing any still waiting. '''
+        self.start()
+        with self.lock:
+            self.pending[key] = value
+            full = len(self.pending) >= self.max_entries
+        if full:
+            self.flush()
+
+    def get(self, key):
+        ''' Return the value waiting to be written for key, or None. '''
+        with self.lock:
+            return self.pending.get(key)
+
+    def flush(self, keys=None):
+        ''' Write the waiting values for keys (all of them if None) now.
+        Waits for any write of the same keys already under way, so the
+        values of a key are written one at a time and in order, and a key
+        has been written by the time this returns. '''
+        with self.written:
+            while self.writing if keys is None else \
+                    self.writing.intersection(keys):
+                self.written.wait()
+            if keys is None:
+                batch, self.pending = self.pending, {}
+            else:
+                batch = dict((key, self.pending.pop(key)) for key in keys
+                             if key in self.pending)
+            self.writing.update(batch)
+        if not batch:
+            return
+        try:
+            self.writer(batch)
+        except Exception:
+            # Put the batch back so the next flush retries it, unless a
+            # newer value arrived in the meantime.
+            with self.lock:
+                for key, value in batch.iteritems():
+                    self.pending.setdefault(key, value)
+            raise
+        finally:
+            with self.written:
+                self.writing.difference_update(batch)
+                self.written.notify_all()
+
+    def start(self):
+        ''' Start the background thread flushing every `interval` seconds.
+        Started lazily so that each forked server worker gets its own. '''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        ''' Stop the background thread and write everything still waiting. '''
+        self.stopped.set()
+        if self.thread is not None and \
+                self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Error writing buffered data")
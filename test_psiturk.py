@@ -6,12 +6,22 @@ import unittest
 import tempfile
 import psiturk
 import json
+import zlib
 from faker import Faker
 
 
 fake = Faker()  # Fake data generator
 
 
+def psiturk_has_module(name):
+    '''Whether an optional package is installed.'''
+    try:
+        __import__('imp').find_module(name)
+        return True
+    except ImportError:
+        return False
+
+
 class FlaskTestClientProxy(object):
     '''Spoof user agent (Chrome)'''
     def __init__(self, app):
@@ -45,6 +55,9 @@ class PsiturkUnitTest(unittest.TestCase):
         os.chdir('psiturk-example')
         import psiturk.db
         import psiturk.experiment
+        import psiturk.psiturk_config
+        # start from the config files, not what earlier tests set
+        psiturk.psiturk_config.reset_config()
         reload(psiturk.experiment)
 
         fd, db_path = tempfile.mkstemp()
@@ -70,6 +83,7 @@ class PsiturkUnitTest(unittest.TestCase):
 
     def set_config(self, section, field, value):
         self.config.parent.set(self.config, section, field, str(value))
+        self.config.refresh_settings()
 
 
 class PsiTurkStandardTests(PsiturkUnitTest):
@@ -102,6 +116,124 @@ class PsiTurkStandardTests(PsiturkUnitTest):
         rv = self.app.get('/ad?%s' % args)
         assert 'Thank you for accepting this HIT!' in rv.data
 
+    def test_psiturk_js_cached(self):
+        '''Test that psiturk.js is served with cache validators.'''
+        rv = self.app.get('/static/js/psiturk.js')
+        assert 'var PsiTurk' in rv.data
+        assert rv.cache_control.max_age > 0
+        rv = self.app.get('/static/js/psiturk.js',
+                          headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+
+        rv = self.app.get('/static/js/psiturk.js',
+                          headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'var PsiTurk' in zlib.decompress(rv.data, 16 + zlib.MAX_WBITS)
+
+    def test_build_static(self):
+        '''Test that fingerprinted static files are cached for good.'''
+        import shutil
+        from psiturk.static_assets import build_static
+        static_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(static_dir, 'css'))
+        with open(os.path.join(static_dir, 'css', 'style.css'), 'w') as css:
+            css.write('body { color: red; }\n' * 100)
+        try:
+            manifest = build_static(static_dir,
+                                    os.path.join(static_dir, 'manifest.json'))
+            built = manifest['css/style.css']
+            assert built != 'css/style.css'
+            assert os.path.exists(os.path.join(static_dir, built + '.gz'))
+
+            psiturk.experiment.app.static_folder = static_dir
+            psiturk.experiment.STATIC_MANIFEST.update(manifest)
+            psiturk.experiment.STATIC_BUILT.update(manifest.values())
+            with psiturk.experiment.app.test_request_context():
+                url = psiturk.experiment.static_url('css/style.css')
+            assert url == '/static/' + built
+
+            rv = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert 'immutable' in rv.headers['Cache-Control']
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert zlib.decompress(rv.data, 16 + zlib.MAX_WBITS).\
+                startswith('body')
+            rv.close()
+            rv = self.app.get('/static/css/style.css')
+            assert 'immutable' not in rv.headers['Cache-Control']
+            rv.close()
+
+            # a file edited since the build falls back to its plain URL
+            with open(os.path.join(static_dir, 'css', 'style.css'),
+                      'w') as css:
+                css.write('body { color: blue; }\n')
+            with psiturk.experiment.app.test_request_context():
+                url = psiturk.experiment.static_url('css/style.css')
+            assert url == '/static/css/style.css'
+        finally:
+            shutil.rmtree(static_dir)
+
+    def test_browser_rules(self):
+        '''Test that browser_exclude_rule keeps out the browsers it names.'''
+        from psiturk.browser_rules import BrowserRules
+        rules = BrowserRules('MSIE, mobile, safari', cache_size=2)
+        chrome = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+                  ' (KHTML, like Gecko) Chrome/60.0.3112.113 Safari/537.36')
+        iphone = ('Mozilla/5.0 (iPhone; CPU iPhone OS 10_3 like Mac OS X) '
+                  'AppleWebKit/603.1.30 (KHTML, like Gecko) Mobile/14E277')
+        safari = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) '
+                  'AppleWebKit/603.3.8 (KHTML, like Gecko) Version/10.1.2 '
+                  'Safari/603.3.8')
+        msie = 'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.1)'
+        assert rules.classify(chrome).allowed
+        assert rules.classify(chrome).browser == 'chrome'
+        assert not rules.classify(iphone).allowed
+        assert not rules.classify(safari).allowed
+        assert not rules.classify(msie).allowed
+        assert list(rules.cache) == [safari, msie]
+
+        args = '&'.join([
+            'assignmentId=debug%s' % self.assignment_id,
+            'workerId=debug%s' % self.worker_id,
+            'hitId=debug%s' % self.hit_id,
+            'mode=sandbox'])
+        rv = self.app.get('/ad?%s' % args)
+        assert 'Thank you for accepting this HIT!' in rv.data
+        # the test client claims to be Chrome
+        self.set_config('HIT Configuration', 'browser_exclude_rule',
+                        'MSIE, Chrome')
+        rv = self.app.get('/ad?%s' % args)
+        assert '<b>Error</b>: 1014' in rv.data
+
+    def test_ad_template_cached(self):
+        '''Test that the ad page is compiled once per mode.'''
+        args = '&'.join([
+            'assignmentId=debug%s' % self.assignment_id,
+            'workerId=debug%s' % self.worker_id,
+            'hitId=debug%s' % self.hit_id,
+            'mode=sandbox'])
+        rv = self.app.get('/ad?%s' % args)
+        cached = psiturk.experiment.MODE_TEMPLATES[('templates/ad.html',
+                                                    'sandbox')]
+        rv = self.app.get('/ad?%s' % args)
+        assert 'mode=sandbox' in rv.data
+        assert psiturk.experiment.MODE_TEMPLATES[('templates/ad.html',
+                                                  'sandbox')] is cached
+
+    def test_exp_with_ad_saved_for_hit(self):
+        '''Test that exp page finds the ad of a HIT created from the shell.'''
+        from psiturk.models import HitAd
+        from psiturk.db import db_session
+        db_session.add(HitAd(hitid=self.hit_id, adid='1234'))
+        db_session.commit()
+        args = '&'.join([
+            'assignmentId=%s' % self.assignment_id,
+            'workerId=%s' % self.worker_id,
+            'hitId=%s' % self.hit_id,
+            'mode=sandbox'])
+        rv = self.app.get('/exp?%s' % args)
+        assert 'https://sandbox.ad.psiturk.org/complete/1234' in rv.data
+        assert self.hit_id in psiturk.experiment.AD_IDS
+
     def test_exp_with_all_url_vars_not_registered_on_ad_server(self):
         '''Test that exp page throws Error #1018 with all url vars but not registered.'''
         args = '&'.join([
@@ -154,6 +286,991 @@ class PsiTurkStandardTests(PsiturkUnitTest):
         assert response.get("counterbalance", None) == 0
         assert response.get("bonus", None) == 0.0
 
+    def test_sync_delta(self):
+        '''Test that delta syncs append to the stored data.'''
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+
+        # put the user in the database
+        rv = self.app.get("/exp?%s" % request)
+
+        # save a full copy of the data with sync PUT
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = {"currenttrial": 1, "data": [{"current_trial": 0}],
+                "eventdata": [], "questiondata": {"age": 24}}
+        rv = self.app.put('/sync/%s' % uniqueid, data=json.dumps(data),
+                          content_type='application/json')
+
+        # append one more trial
+        delta = {"currenttrial": 2, "offsets": {"data": 1, "eventdata": 0},
+                 "data": [{"current_trial": 1}], "eventdata": [],
+                 "questiondata": {"gender": "f"}}
+        rv = self.app.patch('/sync/%s' % uniqueid, data=json.dumps(delta),
+                            content_type='application/json')
+        assert rv.status_code == 200
+        assert json.loads(rv.data)["offsets"] == {"data": 2, "eventdata": 0}
+
+        # retrying the same delta must not duplicate the trial
+        rv = self.app.patch('/sync/%s' % uniqueid, data=json.dumps(delta),
+                            content_type='application/json')
+        assert rv.status_code == 200
+
+        rv = self.app.get('/sync/%s' % uniqueid)
+        response = json.loads(rv.data)
+        assert response["currenttrial"] == 2
+        assert [t["current_trial"] for t in response["data"]] == [0, 1]
+        assert response["questiondata"] == {"age": 24, "gender": "f"}
+
+        # a delta from beyond what is stored is refused
+        delta["offsets"] = {"data": 5, "eventdata": 0}
+        rv = self.app.patch('/sync/%s' % uniqueid, data=json.dumps(delta),
+                            content_type='application/json')
+        assert rv.status_code == 409
+        assert json.loads(rv.data)["offsets"] == {"data": 2, "eventdata": 0}
+
+        # malformed deltas are refused and leave the data alone
+        for malformed in [[1, 2], {"data": 5}, {"eventdata": {}},
+                          {"questiondata": [1]}, {"offsets": [1]},
+                          {"offsets": {"data": "1"}},
+                          {"offsets": {"data": -1}}]:
+            rv = self.app.patch('/sync/%s' % uniqueid,
+                                data=json.dumps(malformed),
+                                content_type='application/json')
+            assert rv.status_code == 400
+        rv = self.app.get('/sync/%s' % uniqueid)
+        assert [t["current_trial"]
+                for t in json.loads(rv.data)["data"]] == [0, 1]
+
+    def test_export_datafiles(self):
+        '''Test that the data files hold the chosen participants' data.'''
+        import shutil
+        from psiturk.db import db_session
+        from psiturk.models import Participant
+        from psiturk.data_export import export_datafiles, parse_status
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({
+            "currenttrial": 2,
+            "data": [{"current_trial": i, "dateTime": 1000 + i,
+                      "trialdata": {"rt": i}} for i in range(2)],
+            "eventdata": [{"eventtype": "resize", "interval": 0,
+                           "value": [800, 600], "timestamp": 1000}],
+            "questiondata": {"age": "30"}})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        codeversion = 'export-%s' % self.assignment_id
+        Participant.query.filter(Participant.uniqueid == uniqueid).\
+            update({'codeversion': codeversion})
+        db_session.commit()
+        user = Participant.query.filter(Participant.uniqueid == uniqueid).\
+            one()
+        expected = [user.get_trial_data(), user.get_event_data(),
+                    user.get_question_data()]
+
+        directory = tempfile.mkdtemp()
+        try:
+            assert export_datafiles(directory, codeversion=codeversion,
+                                    statuses=[parse_status('allocated')],
+                                    mode='debug') == 1
+            for name, contents in zip(['trialdata', 'eventdata',
+                                       'questiondata'], expected):
+                with open(os.path.join(directory, name + '.csv')) as datafile:
+                    assert datafile.read() == contents
+            assert export_datafiles(directory, codeversion=codeversion,
+                                    mode='live') == 0
+            with open(os.path.join(directory, 'trialdata.csv')) as datafile:
+                assert datafile.read() == ''
+        finally:
+            shutil.rmtree(directory)
+        self.assertRaises(ValueError, parse_status, 'finished')
+
+    def test_export_datafiles_jobs(self):
+        '''Test that exporting with several processes gives the same files.'''
+        import shutil
+        from psiturk.data_export import export_datafiles
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({"currenttrial": 1, "eventdata": [],
+                           "data": [{"current_trial": 0, "dateTime": 1,
+                                     "trialdata": {"rt": 1}}],
+                           "questiondata": {}})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+
+        one, three = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            count = export_datafiles(one, mode='debug')
+            assert count > 0
+            assert export_datafiles(three, jobs=3, mode='debug') == count
+            for name in ['trialdata', 'eventdata', 'questiondata']:
+                with open(os.path.join(one, name + '.csv')) as expected:
+                    with open(os.path.join(three, name + '.csv')) as got:
+                        assert got.read() == expected.read()
+            assert sorted(os.listdir(three)) == [
+                'eventdata.csv', 'questiondata.csv', 'trialdata.csv']
+        finally:
+            shutil.rmtree(one)
+            shutil.rmtree(three)
+
+    def test_export_chunks_cover_new_participants(self):
+        '''Test that participants added after the ranges are worked out are
+        still exported, and counted.'''
+        import shutil
+        from psiturk.db import db_session
+        from psiturk.models import Participant
+        from psiturk.data_export import chunk_bounds, export_chunk, DATAFILES
+        # a mode of their own keeps out participants from other tests
+        mode = fake.md5()
+        for worker in ['m1', 'm2', 'm3', 'm4']:
+            db_session.add(Participant(workerid=mode + worker,
+                                       assignmentid='a', hitid='h',
+                                       mode=mode))
+        db_session.commit()
+        participants = Participant.query.filter(Participant.mode == mode)
+        bounds = chunk_bounds(participants, 2)
+        assert len(bounds) == 2
+        # sorting before the first range, between ranges and after the last
+        for worker in ['a', 'm2x', 'z']:
+            db_session.add(Participant(workerid=mode + worker,
+                                       assignmentid='a', hitid='h',
+                                       mode=mode))
+        db_session.commit()
+        directory = tempfile.mkdtemp()
+        try:
+            counts = [export_chunk((directory, number, lower, upper,
+                                    DATAFILES, 10, {'mode': mode}))[1]
+                      for number, (lower, upper) in enumerate(bounds)]
+        finally:
+            shutil.rmtree(directory)
+        assert sum(counts) == 7
+
+    def test_export_data_routes(self):
+        '''Test that data files are streamed to logged in users only.'''
+        import base64
+        from psiturk.db import db_session
+        from psiturk.models import Participant
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({"currenttrial": 1, "eventdata": [],
+                           "questiondata": {"age": "30"},
+                           "data": [{"current_trial": 0, "dateTime": 1,
+                                     "trialdata": {"rt": 1}}]})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        codeversion = 'stream-%s' % self.assignment_id
+        Participant.query.filter(Participant.uniqueid == uniqueid).\
+            update({'codeversion': codeversion}, synchronize_session=False)
+        db_session.commit()
+
+        url = '/data/trialdata.csv?codeversion=%s&status=allocated' % \
+            codeversion
+        login = {'Authorization': 'Basic ' +
+                 base64.b64encode('examplename:examplepassword')}
+        # off by default
+        assert self.app.get(url, headers=login).status_code == 404
+        self.set_config('Server Parameters', 'data_export_routes', 'true')
+        assert self.app.get(url).status_code == 401
+        # never with the example login
+        assert self.app.get(url, headers=login).status_code == 403
+        psiturk.experiment.EXPORT_AUTH.queryname = 'analyst'
+        psiturk.experiment.EXPORT_AUTH.querypw = 'a better password'
+        assert self.app.get(url, headers=login).status_code == 401
+        login = {'Authorization': 'Basic ' +
+                 base64.b64encode('analyst:a better password')}
+
+        rv = self.app.get(url, headers=login)
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/csv'
+        assert rv.data == '%s,0,1,"{""rt"": 1}"\r\n' % uniqueid
+        rv = self.app.get('/data/questiondata.ndjson?codeversion=%s' %
+                          codeversion, headers=login)
+        assert [json.loads(line) for line in rv.data.splitlines()] == [
+            {"uniqueid": uniqueid, "question": "age", "response": "30"}]
+        rv = self.app.get('/data/trialdata.ndjson?codeversion=%s&mode=live' %
+                          codeversion, headers=login)
+        assert rv.data == ''
+        rv = self.app.get(url + '&since=yesterday', headers=login)
+        assert rv.status_code == 400
+        # empty parameters are ignored
+        rv = self.app.get(url + '&since=&until=&mode=&status=',
+                          headers=login)
+        assert rv.data == '%s,0,1,"{""rt"": 1}"\r\n' % uniqueid
+        rv = self.app.get('/data/participants.csv', headers=login)
+        assert rv.status_code == 404
+
+    def test_export_incremental(self):
+        '''Test that incremental exports only read changed participants.'''
+        import shutil
+        import datetime
+        from psiturk.db import db_session
+        from psiturk.models import Participant
+        from psiturk import data_export
+        from psiturk.data_export import export_incremental, merge_incremental
+        codeversion = 'incremental-%s' % self.assignment_id
+
+        def add_participant(worker_id):
+            request = "&".join([
+               "assignmentId=debug%s" % self.assignment_id,
+               "workerId=debug%s" % worker_id,
+               "hitId=debug%s" % self.hit_id,
+               "mode=debug"])
+            rv = self.app.get("/exp?%s" % request)
+            uniqueid = "debug%s:debug%s" % (worker_id, self.assignment_id)
+            data = json.dumps({"currenttrial": 1, "eventdata": [],
+                               "questiondata": {},
+                               "data": [{"current_trial": 0, "dateTime": 1,
+                                         "trialdata": {"rt": 1}}]})
+            rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                              content_type='application/json')
+            Participant.query.filter(Participant.uniqueid == uniqueid).\
+                update({'codeversion': codeversion},
+                       synchronize_session=False)
+            db_session.commit()
+            return uniqueid
+
+        def shard(directory, run):
+            with open(os.path.join(directory, 'datafiles', run,
+                                   'uniqueids.json')) as uniqueids:
+                return json.load(uniqueids)
+
+        def uniqueids(path):
+            with open(path) as datafile:
+                return [line.split(',')[0]
+                        for line in datafile.read().splitlines()]
+
+        first = add_participant(self.worker_id)
+        directory = tempfile.mkdtemp()
+        compact_after = data_export.COMPACT_AFTER
+        try:
+            assert export_incremental(directory, codeversion=codeversion)[1] \
+                == 1
+            assert uniqueids(os.path.join(directory, 'datafiles', '000001',
+                                          'trialdata.csv')) == [first]
+            # nothing changed, so nothing is read or written
+            assert export_incremental(directory, codeversion=codeversion) \
+                == (0, 0)
+            assert sorted(os.listdir(os.path.join(directory, 'datafiles'))) \
+                == ['000001', 'watermark.json']
+
+            second = add_participant(fake.md5(raw_output=False))
+            user = Participant.query.\
+                filter(Participant.uniqueid == second).one()
+            assert export_incremental(directory, codeversion=codeversion) \
+                == (1, 1)
+            assert shard(directory, '000002') == {'read': [second],
+                                                  'written': [second]}
+            assert uniqueids(os.path.join(directory, 'datafiles', '000002',
+                                          'trialdata.csv')) == [second]
+            watermark = data_export.load_watermark(
+                os.path.join(directory, 'datafiles'))
+            assert watermark['last_modified'] == \
+                user.last_modified.strftime(data_export.WATERMARK_FORMAT)
+            assert watermark['recent'][second] == watermark['last_modified']
+            assert watermark['runs'] == ['000001', '000002']
+
+            # a change stamped before the watermark but committed after the
+            # export is still read
+            Participant.query.filter(Participant.uniqueid == first).\
+                update({'last_modified': user.last_modified -
+                        datetime.timedelta(seconds=1)},
+                       synchronize_session=False)
+            db_session.commit()
+            assert export_incremental(directory, codeversion=codeversion) \
+                == (1, 1)
+            assert shard(directory, '000003') == {'read': [first],
+                                                  'written': [first]}
+            assert uniqueids(os.path.join(directory, 'datafiles', '000003',
+                                          'trialdata.csv')) == [first]
+            assert data_export.load_watermark(
+                os.path.join(directory, 'datafiles'))['last_modified'] == \
+                watermark['last_modified']
+            assert export_incremental(directory, codeversion=codeversion) \
+                == (0, 0)
+
+            assert merge_incremental(directory) == 2
+            assert uniqueids(os.path.join(directory, 'trialdata.csv')) == \
+                sorted([first, second])
+
+            # the first participant no longer matches, and the shards are
+            # compacted into one
+            Participant.query.filter(Participant.uniqueid == first).\
+                update({'codeversion': 'other-' + codeversion,
+                        'last_modified': datetime.datetime.now()},
+                       synchronize_session=False)
+            db_session.commit()
+            data_export.COMPACT_AFTER = 3
+            assert export_incremental(directory, codeversion=codeversion) \
+                == (1, 0)
+            assert sorted(os.listdir(os.path.join(directory, 'datafiles'))) \
+                == ['000005', 'watermark.json']
+            assert merge_incremental(directory) == 1
+            assert uniqueids(os.path.join(directory, 'trialdata.csv')) == \
+                [second]
+        finally:
+            data_export.COMPACT_AFTER = compact_after
+            shutil.rmtree(directory)
+
+    def test_trial_columns(self):
+        '''Test that trial data is flattened into typed columns.'''
+        from psiturk.models import Participant
+        from psiturk.data_export import flatten_trialdata, trial_records, \
+            trial_schema, trial_columns
+        assert flatten_trialdata(['TEST', 3]) == {
+            'trialdata.0': 'TEST', 'trialdata.1': 3}
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({"currenttrial": 2, "eventdata": [],
+                           "questiondata": {}, "data": [
+            {"current_trial": 0, "dateTime": 1000,
+             "trialdata": {"rt": 1, "hit": True, "stim": {"color": "red"}}},
+            {"current_trial": 1, "dateTime": 2000,
+             "trialdata": {"rt": 1.5, "hit": False, "extra": [1, 2]}}]})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+
+        participants = Participant.query.\
+            filter(Participant.uniqueid == uniqueid)
+        schema = trial_schema(trial_records(participants, 10))
+        assert schema == [
+            ('uniqueid', 'string'), ('current_trial', 'int'),
+            ('dateTime', 'int'), ('trialdata.extra', 'string'),
+            ('trialdata.hit', 'bool'), ('trialdata.rt', 'float'),
+            ('trialdata.stim.color', 'string')]
+        columns = trial_columns(trial_records(participants, 10), schema)
+        assert columns['current_trial'] == [0, 1]
+        assert columns['trialdata.rt'] == [1.0, 1.5]
+        assert columns['trialdata.hit'] == [True, False]
+        assert columns['trialdata.extra'] == [None, '[1, 2]']
+        assert columns['trialdata.stim.color'] == ['red', None]
+
+    def columnar_fixture(self):
+        '''Save two trials for a participant; return a query for them.'''
+        from psiturk.models import Participant
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({"currenttrial": 2, "eventdata": [],
+                           "questiondata": {}, "data": [
+            {"current_trial": 0, "dateTime": 1000,
+             "trialdata": {"rt": 1, "hit": True, "word": u"r\xf6d"}},
+            {"current_trial": 1, "dateTime": 2000,
+             "trialdata": {"rt": 1.5, "hit": False}}]})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        return uniqueid, Participant.query.\
+            filter(Participant.uniqueid == uniqueid)
+
+    @unittest.skipUnless(psiturk_has_module('pyarrow'), 'needs pyarrow')
+    def test_columnar_parquet(self):
+        '''Test that trials written to Parquet read back as typed columns.'''
+        import shutil
+        import pyarrow.parquet
+        from psiturk.data_export import export_trials_columnar
+        uniqueid, participants = self.columnar_fixture()
+        directory = tempfile.mkdtemp()
+        try:
+            path = export_trials_columnar(directory, participants, 10,
+                                          'parquet')
+            table = pyarrow.parquet.read_table(path)
+            columns = dict((name, table.column(name).to_pylist())
+                           for name in table.schema.names)
+        finally:
+            shutil.rmtree(directory)
+        assert table.schema.names == [
+            'uniqueid', 'current_trial', 'dateTime', 'trialdata.hit',
+            'trialdata.rt', 'trialdata.word']
+        assert columns['uniqueid'] == [uniqueid, uniqueid]
+        assert columns['trialdata.hit'] == [True, False]
+        assert columns['trialdata.rt'] == [1.0, 1.5]
+        assert columns['trialdata.word'] == [u'r\xf6d', None]
+
+    @unittest.skipUnless(psiturk_has_module('numpy'), 'needs numpy')
+    def test_columnar_npy(self):
+        '''Test that trials written to .npy files memory-map as columns.'''
+        import shutil
+        import numpy
+        from psiturk.data_export import export_trials_columnar, npy_path, \
+            npy_strings
+        uniqueid, participants = self.columnar_fixture()
+        directory = tempfile.mkdtemp()
+        try:
+            folder = export_trials_columnar(directory, participants, 1, 'npy')
+            with open(os.path.join(folder, 'columns.json')) as names:
+                names = json.load(names)
+            assert names == ['uniqueid', 'current_trial', 'dateTime',
+                             'trialdata.hit', 'trialdata.rt',
+                             'trialdata.word']
+            columns = dict((name, numpy.load(npy_path(folder, name),
+                                             mmap_mode='r'))
+                           for name in names[1:5])
+            assert isinstance(columns['trialdata.rt'], numpy.memmap)
+            assert list(npy_strings(folder, 'uniqueid')) == \
+                [uniqueid, uniqueid]
+            assert columns['current_trial'].dtype == numpy.int64
+            assert list(columns['trialdata.hit']) == [True, False]
+            assert list(columns['trialdata.rt']) == [1.0, 1.5]
+            assert list(npy_strings(folder, 'trialdata.word')) == \
+                [u'r\xf6d', u'']
+            del columns
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipUnless(psiturk_has_module('numpy'), 'needs numpy')
+    def test_columnar_npy_long_text(self):
+        '''Test that one long text value does not widen a whole column.'''
+        import shutil
+        from psiturk.models import Participant
+        from psiturk.data_export import export_trials_columnar, npy_path, \
+            npy_strings
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        track = range(10000)
+        data = json.dumps({"currenttrial": 100, "eventdata": [],
+                           "questiondata": {}, "data": [
+            {"current_trial": i, "dateTime": i,
+             "trialdata": {"track": track if i == 0 else [i]}}
+            for i in range(100)]})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        participants = Participant.query.\
+            filter(Participant.uniqueid == uniqueid)
+        directory = tempfile.mkdtemp()
+        try:
+            folder = export_trials_columnar(directory, participants, 10,
+                                            'npy')
+            values = list(npy_strings(folder, 'trialdata.track'))
+            size = os.path.getsize(npy_path(folder, 'trialdata.track'))
+        finally:
+            shutil.rmtree(directory)
+        assert json.loads(values[0]) == track
+        assert [json.loads(value) for value in values[1:]] == \
+            [[i] for i in range(1, 100)]
+        # the long value is stored once, not padded out for every trial
+        assert size < 2 * sum(len(value) for value in values)
+
+    @unittest.skipUnless(psiturk_has_module('pyarrow') or
+                         psiturk_has_module('numpy'), 'needs pyarrow or numpy')
+    def test_columnar_with_jobs(self):
+        '''Test that a columnar export can use several processes.'''
+        import shutil
+        from psiturk.data_export import export_datafiles, columnar_format, \
+            COLUMNAR_FILES
+        uniqueid, participants = self.columnar_fixture()
+        codeversion = 'columnar-%s' % self.assignment_id
+        participants.update({'codeversion': codeversion},
+                            synchronize_session=False)
+        psiturk.experiment.db_session.commit()
+        directory = tempfile.mkdtemp()
+        try:
+            assert export_datafiles(directory, jobs=2, columnar=True,
+                                    codeversion=codeversion) == 1
+            assert sorted(os.listdir(directory)) == sorted([
+                COLUMNAR_FILES[columnar_format()], 'eventdata.csv',
+                'questiondata.csv'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_datastring_deferred(self):
+        '''Test that participant data is only loaded when asked for.'''
+        from sqlalchemy import inspect
+        from sqlalchemy.orm import undefer
+        from psiturk.db import db_session
+        from psiturk.models import Participant
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({"currenttrial": 2, "data": [], "eventdata": [],
+                           "questiondata": {}})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        assert json.loads(rv.data)["status"] == "user data saved"
+
+        db_session.remove()
+        query = Participant.query.filter(Participant.uniqueid == uniqueid)
+        user = query.one()
+        assert 'datastring' in inspect(user).unloaded
+        assert json.loads(user.datastring)["currenttrial"] == 2
+        db_session.remove()
+        user = query.options(undefer('datastring')).one()
+        assert 'datastring' not in inspect(user).unloaded
+        db_session.remove()
+
+        # revalidating a load does not read the data from the database
+        from sqlalchemy import event
+        from psiturk.db import engine
+        etag = self.app.get('/sync/%s' % uniqueid).headers['ETag']
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            rv = self.app.get('/sync/%s' % uniqueid,
+                              headers={'If-None-Match': etag})
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        assert rv.status_code == 304
+        assert statements
+        assert not [statement for statement in statements
+                    if 'datastring' in statement]
+
+    def test_sync_etag(self):
+        '''Test that unchanged data is neither rewritten nor resent.'''
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+
+        # put the user in the database
+        rv = self.app.get("/exp?%s" % request)
+
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = json.dumps({"currenttrial": 1, "data": [], "eventdata": [],
+                           "questiondata": {}})
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        etag = rv.headers['ETag']
+        assert json.loads(rv.data)["status"] == "user data saved"
+
+        # saving the same data again is acknowledged without a write
+        rv = self.app.put('/sync/%s' % uniqueid, data=data,
+                          content_type='application/json')
+        assert rv.headers['ETag'] == etag
+        assert json.loads(rv.data)["status"] == "user data unchanged"
+
+        rv = self.app.get('/sync/%s' % uniqueid,
+                          headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        rv = self.app.get('/sync/%s' % uniqueid,
+                          headers={'If-None-Match': '"stale"'})
+        assert rv.status_code == 200
+        assert json.loads(rv.data)["currenttrial"] == 1
+
+    def test_sync_gzip(self):
+        '''Test that gzipped saves are accepted and large loads are gzipped.'''
+        import gzip, StringIO
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+
+        # put the user in the database
+        rv = self.app.get("/exp?%s" % request)
+
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = {"currenttrial": 100, "eventdata": [], "questiondata": {},
+                "data": [{"current_trial": i} for i in range(100)]}
+        body = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as gzipped:
+            gzipped.write(json.dumps(data))
+        rv = self.app.put('/sync/%s' % uniqueid, data=body.getvalue(),
+                          content_type='application/json',
+                          headers={'Content-Encoding': 'gzip'})
+        assert rv.status_code == 200
+
+        rv = self.app.put('/sync/%s' % uniqueid, data='not gzip',
+                          content_type='application/json',
+                          headers={'Content-Encoding': 'gzip'})
+        assert rv.status_code == 400
+
+        rv = self.app.get('/sync/%s' % uniqueid,
+                          headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        response = gzip.GzipFile(fileobj=StringIO.StringIO(rv.data)).read()
+        assert json.loads(response)["data"] == data["data"]
+        # the two encodings have different ETags, either of which revalidates
+        gzip_etag = rv.headers['ETag']
+        assert gzip_etag.endswith('-gzip"')
+        rv = self.app.get('/sync/%s' % uniqueid,
+                          headers={'Accept-Encoding': 'gzip',
+                                   'If-None-Match': gzip_etag})
+        assert rv.status_code == 304
+        assert rv.headers['ETag'] == gzip_etag
+
+        rv = self.app.get('/sync/%s' % uniqueid)
+        assert 'Content-Encoding' not in rv.headers
+        assert json.loads(rv.data)["currenttrial"] == 100
+        assert rv.headers['ETag'] != gzip_etag
+
+    def test_sync_normalized_data(self):
+        '''Test that synced data is written to the trial/event/question tables.'''
+        from psiturk.models import TrialData, EventData, QuestionData
+        self.set_config('Database Parameters', 'normalized_data', 'true')
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+
+        # put the user in the database
+        rv = self.app.get("/exp?%s" % request)
+
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = {"data": [{"current_trial": 0, "dateTime": 1,
+                          "trialdata": {"rt": 500}}],
+                "eventdata": [{"eventtype": "focus", "value": "on",
+                               "interval": 0, "timestamp": 1}],
+                "questiondata": {"age": 24}}
+        rv = self.app.put('/sync/%s' % uniqueid, data=json.dumps(data),
+                          content_type='application/json')
+        delta = {"offsets": {"data": 1, "eventdata": 1},
+                 "data": [{"current_trial": 1, "dateTime": 2,
+                           "trialdata": {"rt": 600}}],
+                 "eventdata": [], "questiondata": {"age": 25}}
+        rv = self.app.patch('/sync/%s' % uniqueid, data=json.dumps(delta),
+                            content_type='application/json')
+        assert rv.status_code == 200
+
+        trials = TrialData.query.filter(TrialData.uniqueid == uniqueid).\
+            order_by(TrialData.seq).all()
+        assert [json.loads(t.payload)["rt"] for t in trials] == [500, 600]
+        assert EventData.query.filter(EventData.uniqueid == uniqueid).count() == 1
+        questions = QuestionData.query.\
+            filter(QuestionData.uniqueid == uniqueid).all()
+        assert [(q.question, q.response) for q in questions] == [("age", "25")]
+
+        # and read back from them, not from the datastring
+        from psiturk.db import db_session
+        from psiturk.models import Participant
+        TrialData.query.filter(TrialData.id == trials[0].id).\
+            update({'payload': json.dumps({"rt": 501})},
+                   synchronize_session=False)
+        db_session.commit()
+        user = Participant.query.filter(Participant.uniqueid == uniqueid).\
+            one()
+        assert '""rt"": 501' in user.get_trial_data()
+
+    def test_sync_write_behind(self):
+        '''Test that buffered syncs are served back and written on completion.'''
+        from psiturk.models import Participant
+        self.set_config('Server Parameters', 'sync_write_behind', 'true')
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+
+        # put the user in the database
+        rv = self.app.get("/exp?%s" % request)
+
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+        data = {"currenttrial": 1, "data": [{"current_trial": 0}],
+                "eventdata": [], "questiondata": {}}
+        rv = self.app.put('/sync/%s' % uniqueid, data=json.dumps(data),
+                          content_type='application/json')
+        assert rv.status_code == 200
+
+        # the save waits in the buffer but is what the participant gets back
+        user = Participant.query.filter(Participant.uniqueid == uniqueid).one()
+        assert user.datastring is None
+        rv = self.app.get('/sync/%s' % uniqueid)
+        assert json.loads(rv.data)["currenttrial"] == 1
+
+        # completing the experiment writes it to the database
+        rv = self.app.get('/complete?uniqueId=%s&mode=debug' % uniqueid)
+        assert rv.status_code == 200
+        Participant.query.session.expire_all()
+        user = Participant.query.filter(Participant.uniqueid == uniqueid).one()
+        assert json.loads(user.datastring)["currenttrial"] == 1
+
+    def test_sync_write_behind_flush(self):
+        '''Test that flushed saves are written at once, that completing
+        survives a failed flush, and that stale saves are not written.'''
+        import psiturk.experiment
+        from psiturk.models import Participant
+        from psiturk.db import db_session
+        self.set_config('Server Parameters', 'sync_write_behind', 'true')
+        request = "&".join([
+           "assignmentId=debug%s" % self.assignment_id,
+           "workerId=debug%s" % self.worker_id,
+           "hitId=debug%s" % self.hit_id,
+           "mode=debug"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "debug%s:debug%s" % (self.worker_id, self.assignment_id)
+
+        def stored():
+            Participant.query.session.expire_all()
+            user = Participant.query.\
+                filter(Participant.uniqueid == uniqueid).one()
+            return json.loads(user.datastring)["currenttrial"]
+
+        data = {"currenttrial": 2, "data": [{"current_trial": 0},
+                                            {"current_trial": 1}]}
+        rv = self.app.put('/sync/%s' % uniqueid, data=json.dumps(data),
+                          content_type='application/json',
+                          headers={'X-Sync-Flush': 'true'})
+        assert rv.status_code == 200
+        assert stored() == 2
+
+        # an older save buffered by another worker does not replace it
+        older = {"currenttrial": 1, "data": [{"current_trial": 0}]}
+        psiturk.experiment.write_buffered_data(
+            {uniqueid: (json.dumps(older), older)})
+        assert stored() == 2
+
+        # a failing flush is logged, and the participant still completes
+        def fail(batch):
+            raise RuntimeError("database down")
+        writer = psiturk.experiment.SYNC_BUFFER.writer
+        psiturk.experiment.SYNC_BUFFER.writer = fail
+        try:
+            rv = self.app.put('/sync/%s' % uniqueid, data=json.dumps(data),
+                              content_type='application/json')
+            rv = self.app.get('/complete?uniqueId=%s&mode=debug' % uniqueid)
+            assert rv.status_code == 200
+        finally:
+            psiturk.experiment.SYNC_BUFFER.writer = writer
+        assert psiturk.experiment.SYNC_BUFFER.get(uniqueid) is not None
+        psiturk.experiment.SYNC_BUFFER.flush()
+
+    def test_write_buffer_order(self):
+        '''Test that writes of the same key never overlap or reorder.'''
+        import threading
+        from psiturk.write_buffer import WriteBehindBuffer
+        written = []
+        first_started = threading.Event()
+        release = threading.Event()
+
+        def writer(batch):
+            if not written:
+                first_started.set()
+                release.wait(5)
+            written.append(batch)
+        buffer = WriteBehindBuffer(writer, interval=60)
+        buffer.pending['uid'] = 1
+        first = threading.Thread(target=buffer.flush)
+        first.start()
+        first_started.wait(5)
+        buffer.pending['uid'] = 2
+        second = threading.Thread(target=buffer.flush, args=(['uid'],))
+        second.start()
+        second.join(0.2)
+        # the second write waits for the first to finish
+        assert second.is_alive()
+        release.set()
+        first.join(5)
+        second.join(5)
+        assert written == [{'uid': 1}, {'uid': 2}]
+
+    def test_random_condcount(self):
+        '''Test that the least filled condition is chosen.'''
+        import datetime
+        from psiturk.models import Participant
+        from psiturk.db import db_session
+        self.set_config('Task Parameters', 'num_conds', 2)
+        self.set_config('Task Parameters', 'num_counters', 1)
+        # a fresh code version, so earlier runs' participants don't count
+        codeversion = fake.md5()
+        self.set_config('Task Parameters', 'experiment_code_version',
+                        codeversion)
+
+        def add(cond, status, beginhit):
+            participant = Participant(workerid=fake.md5(), hitid=self.hit_id,
+                                      assignmentid=fake.md5(), cond=cond,
+                                      counterbalance=0, mode='sandbox')
+            participant.status = status
+            participant.beginhit = beginhit
+            participant.codeversion = codeversion
+            db_session.add(participant)
+
+        now = datetime.datetime.now()
+        long_ago = now - datetime.timedelta(days=1)
+        for _ in range(3):
+            add(0, psiturk.experiment.COMPLETED, long_ago)
+        add(1, psiturk.experiment.SUBMITTED, long_ago)
+        add(1, psiturk.experiment.STARTED, now)
+        # abandoned long ago, so no longer counted
+        for _ in range(5):
+            add(1, psiturk.experiment.STARTED, long_ago)
+        db_session.commit()
+
+        chosen = psiturk.experiment.get_random_condcount('sandbox')
+        assert chosen == (1, 0)
+
+    def test_sqlite_pragmas(self):
+        '''Test that SQLite connections are set up for concurrent workers.'''
+        import sqlite3
+        import psiturk.db
+        from psiturk.db import engine
+        assert engine.execute('PRAGMA busy_timeout').scalar() == 5000
+
+        # write-ahead logging is opt-in
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for wal, mode in [('false', 'delete'), ('true', 'wal')]:
+                psiturk.db.config.set('Database Parameters', 'sqlite_wal',
+                                      wal)
+                connection = sqlite3.connect(path)
+                psiturk.db.set_sqlite_pragmas(connection, None)
+                assert connection.execute(
+                    'PRAGMA journal_mode').fetchone()[0] == mode
+                if wal == 'true':
+                    # NORMAL
+                    assert connection.execute(
+                        'PRAGMA synchronous').fetchone()[0] == 1
+                connection.close()
+        finally:
+            psiturk.db.config.set('Database Parameters', 'sqlite_wal',
+                                  'false')
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_add_indexes(self):
+        '''Test that missing participant table indexes are added once.'''
+        from sqlalchemy import inspect
+        from psiturk.db import engine
+        from psiturk.models import Participant, TABLENAME, add_indexes
+        add_indexes()
+        names = [index['name'] for index in
+                 inspect(engine).get_indexes(TABLENAME)]
+        for index in Participant.__table__.indexes:
+            assert index.name in names
+        assert add_indexes() == []
+
+    def test_condcount_claims(self):
+        '''Test that condition claims are counted until the next sweep.'''
+        from psiturk.models import ConditionCount
+        self.set_config('Task Parameters', 'num_conds', 2)
+        self.set_config('Task Parameters', 'num_counters', 1)
+        codeversion = fake.md5()
+        self.set_config('Task Parameters', 'experiment_code_version',
+                        codeversion)
+
+        # claims are spread over the conditions before anyone is added
+        chosen = [psiturk.experiment.get_random_condcount('sandbox')
+                  for _ in range(4)]
+        assert sorted(chosen) == [(0, 0), (0, 0), (1, 0), (1, 0)]
+        counts = ConditionCount.query.filter_by(codeversion=codeversion)
+        assert [row.count for row in counts] == [2, 2]
+
+        # claims that never became participants are swept away
+        psiturk.experiment.LAST_CONDCOUNT_SWEEP.clear()
+        psiturk.experiment.get_random_condcount('sandbox')
+        psiturk.experiment.db_session.expire_all()
+        assert sorted(row.count for row in counts) == [0, 1]
+
+        # a claim made elsewhere after a sweep read the counts is kept
+        stored = psiturk.experiment.read_condcounts(
+            counts, self.config.settings.condition_keys)
+        counts.update({ConditionCount.count: ConditionCount.count + 1},
+                      synchronize_session=False)
+        read_condcounts = psiturk.experiment.read_condcounts
+        psiturk.experiment.read_condcounts = lambda slots, keys: stored
+        try:
+            psiturk.experiment.sweep_condcounts(
+                'sandbox', self.config.settings.condition_keys)
+        finally:
+            psiturk.experiment.read_condcounts = read_condcounts
+        psiturk.experiment.db_session.expire_all()
+        assert sorted(row.count for row in counts) == [1, 2]
+
+        # a condition without a row gets one before it is claimed
+        counts.delete(synchronize_session=False)
+        psiturk.experiment.db_session.commit()
+        chosen = psiturk.experiment.get_random_condcount('sandbox')
+        psiturk.experiment.db_session.expire_all()
+        assert dict(((row.cond, row.counterbalance), row.count)
+                    for row in counts)[chosen] == 1
+        assert counts.count() == 2
+
+    def test_settings_snapshot(self):
+        '''Test that config settings are parsed up front and checked.'''
+        settings = self.config.settings
+        assert settings.allow_repeats is False
+        assert isinstance(settings.cutoff_time, int)
+        # changes only show once the settings are refreshed
+        self.config.parent.set(self.config, 'HIT Configuration',
+                               'allow_repeats', 'true')
+        assert self.config.settings.allow_repeats is False
+        assert self.config.refresh_settings().allow_repeats is True
+        self.config.parent.set(self.config, 'Server Parameters',
+                               'cutoff_time', 'thirty')
+        self.assertRaises(ValueError, self.config.refresh_settings)
+
+    def test_shared_config(self):
+        '''Test that the server's modules share one config, read once.'''
+        from psiturk.psiturk_config import get_config
+        assert get_config() is self.config
+        assert get_config() is get_config()
+
+    def test_startup_profile(self):
+        '''Test that startup imports are timed.'''
+        import sys
+        from psiturk.startup_profile import ImportTimer
+        sys.modules.pop('colorsys', None)
+        with ImportTimer() as timer:
+            import colorsys
+        assert 'colorsys' in timer.times
+        cumulative, own = timer.times['colorsys']
+        assert cumulative >= own > 0
+        assert timer.report(1)[1].endswith('colorsys')
+
+    def test_shell_imports_lazily(self):
+        '''Test that the shell loads requests only once a service is used.'''
+        import sys
+        import subprocess
+        script = ("import sys\n"
+                  "import psiturk.psiturk_shell\n"
+                  "from psiturk.amt_services_wrapper import "
+                  "MTurkServicesWrapper\n"
+                  "MTurkServicesWrapper()\n"
+                  "print(sorted(set(['requests', 'boto3']) & "
+                  "set(sys.modules)))\n")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.dirname(os.path.abspath(psiturk.__file__))))
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=env)
+        assert output.strip() == '[]'
+
+    def test_compressed_datastring(self):
+        '''Test that compressed datastrings round trip, as do old uncompressed ones.'''
+        from psiturk.models import CompressedText
+        column_type = CompressedText()
+        datastring = json.dumps({"data": [{"current_trial": 0}] * 100})
+        stored = column_type.process_bind_param(datastring, None)
+        assert len(stored) < len(datastring)
+        assert column_type.process_result_value(stored, None) == datastring
+        assert column_type.process_result_value(datastring, None) == datastring
+
     def test_favicon(self):
         '''Test that favicon loads.'''
         rv = self.app.get('/favicon.ico')
@@ -181,6 +1298,60 @@ class PsiTurkStandardTests(PsiturkUnitTest):
         rv = self.app.get('/complete?uniqueId=%s&mode=%s' % (uniqueid, mode))
         assert rv.status_code == 200
 
+    def test_check_worker_status(self):
+        '''Test that a worker's status reflects all of their assignments.'''
+        request = "&".join([
+            "assignmentId=%s" % self.assignment_id,
+            "workerId=%s" % self.worker_id,
+            "hitId=%s" % self.hit_id,
+            "mode=debug"])
+        status_url = '/check_worker_status?workerId=%s&assignmentId=%s'
+
+        rv = self.app.get(status_url % (self.worker_id, self.assignment_id))
+        assert json.loads(rv.data)["status"] == 0
+
+        # put the user in the database and complete the experiment
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "%s:%s" % (self.worker_id, self.assignment_id)
+        rv = self.app.get('/worker_complete?uniqueId=%s' % uniqueid)
+
+        rv = self.app.get(status_url % (self.worker_id, self.assignment_id))
+        assert json.loads(rv.data)["status"] == 3
+        # without repeats, any assignment reports the worker's furthest status
+        rv = self.app.get(status_url % (self.worker_id, 'other'))
+        assert json.loads(rv.data)["status"] == 3
+        self.set_config('HIT Configuration', 'allow_repeats', 'true')
+        rv = self.app.get(status_url % (self.worker_id, 'other'))
+        assert json.loads(rv.data)["status"] == 0
+
+    def test_status_transitions(self):
+        '''Test that a participant's status only moves forward.'''
+        from psiturk.models import Participant, SUBMITTED
+        request = "&".join([
+            "assignmentId=%s" % self.assignment_id,
+            "workerId=%s" % self.worker_id,
+            "hitId=%s" % self.hit_id,
+            "mode=sandbox"])
+        rv = self.app.get("/exp?%s" % request)
+        uniqueid = "%s:%s" % (self.worker_id, self.assignment_id)
+
+        rv = self.app.post("/inexp", data=dict(uniqueId=uniqueid))
+        assert json.loads(rv.data)["status"] == "success"
+        rv = self.app.get('/worker_complete?uniqueId=%s' % uniqueid)
+        assert json.loads(rv.data)["status"] == "success"
+        rv = self.app.get('/worker_submitted?uniqueId=%s' % uniqueid)
+        assert json.loads(rv.data)["status"] == "success"
+
+        # a late quit or a second completion can't undo the submission
+        rv = self.app.post("/quitter", data=dict(uniqueId=uniqueid))
+        assert ': 1011' in rv.data
+        rv = self.app.get('/worker_complete?uniqueId=%s' % uniqueid)
+        assert json.loads(rv.data)["status"] == "status not changed"
+        rv = self.app.post("/inexp", data=dict(uniqueId=uniqueid))
+        assert json.loads(rv.data)["status"] != "success"
+        user = Participant.query.filter(Participant.uniqueid == uniqueid).one()
+        assert user.status == SUBMITTED
+
     def test_repeat_experiment_fail(self):
         '''Test that a participant cannot repeat the experiment.'''
         request = "&".join([
@@ -364,6 +1535,9 @@ class BadUserAgent(PsiturkUnitTest):
         os.chdir('psiturk-example')
         import psiturk.db
         import psiturk.experiment
+        import psiturk.psiturk_config
+        # start from the config files, not what earlier tests set
+        psiturk.psiturk_config.reset_config()
         reload(psiturk.experiment)
 
         fd, db_path = tempfile.mkstemp()
@@ -398,6 +1572,9 @@ class PsiTurkTestPsiturkJS(PsiturkUnitTest):
         os.rename(self.PSITURK_JS_FILE, self.PSITURK_JS_FILE + '.bup')
         import psiturk.db
         import psiturk.experiment
+        import psiturk.psiturk_config
+        # start from the config files, not what earlier tests set
+        psiturk.psiturk_config.reset_config()
         reload(psiturk.experiment)
 
         fd, db_path = tempfile.mkstemp()